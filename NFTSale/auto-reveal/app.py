@@ -5,7 +5,9 @@ from aws_cdk import (
     aws_s3 as s3,
     aws_iam as iam,
     aws_lambda as lambda_,
+    AssetHashType,
     BundlingOptions,
+    DockerVolume,
     aws_events as events,
     aws_events_targets as targets,
     aws_secretsmanager as sm,
@@ -19,6 +21,7 @@ CHAIN_ID = os.environ['CHAIN_ID']
 NFT_CONTRACT = os.environ['NFT_CONTRACT']
 POLICY_CONTRACT = os.environ['POLICY_CONTRACT']
 COLLECTION = os.environ['COLLECTION']
+KADENA_NODE_URL = os.environ.get('KADENA_NODE_URL', 'https://api.chainweb.com')
 
 
 from pathlib import Path
@@ -26,6 +29,9 @@ THIS_DIR = Path(__file__).parent
 
 RESOURCES_DIR = THIS_DIR / "resources"
 REVEAL_FUNCTION_DIR = RESOURCES_DIR / "nft-reveal-handler"
+# The handler imports modules the scripts share, they only live there
+NFT_SCRIPTS_DIR = THIS_DIR.parent / "scripts"
+SCRIPTS_DIR = THIS_DIR.parent.parent / "scripts"
 
 class NFTStack(Stack):
     def __init__(self, scope: Construct, id: str, **kwargs) -> None:
@@ -74,10 +80,17 @@ class NFTStack(Stack):
             runtime=lambda_.Runtime.PYTHON_3_9,
             code=lambda_.Code.from_asset(
               str(REVEAL_FUNCTION_DIR),
+              # Hash the bundle, so changes to the shared modules redeploy it
+              asset_hash_type=AssetHashType.OUTPUT,
               bundling=BundlingOptions(
                 image=lambda_.Runtime.PYTHON_3_9.bundling_image,
+                volumes=[
+                  DockerVolume(host_path=str(NFT_SCRIPTS_DIR), container_path="/nft-scripts"),
+                  DockerVolume(host_path=str(SCRIPTS_DIR), container_path="/scripts"),
+                ],
                 command=[
                   "bash", "-c", "pip install -r requirements.txt -t /asset-output && cp -au . /asset-output"
+                    " && cp /nft-scripts/token_manifest.py /scripts/gas_estimator.py /asset-output"
                 ]
               ),
             ),
@@ -87,7 +100,7 @@ class NFTStack(Stack):
               SECRET_NAME=secret_name,
               BUCKET=bucket.bucket_name,
               REGION='us-west-2',
-              KADENA_NODE_URL="https://api.chainweb.com",
+              KADENA_NODE_URL=KADENA_NODE_URL,
               CHAIN_ID=CHAIN_ID,
               NFT_CONTRACT=NFT_CONTRACT,
               POLICY_CONTRACT=POLICY_CONTRACT,
@@ -1,11 +1,19 @@
+import time
+# Measures the cold start, from the first import to the end of the module
+_INIT_START = time.perf_counter()
+
 import os
+import math
 import requests
 import json
+from concurrent.futures import ThreadPoolExecutor
 from kadena_sdk.kadena_sdk import KadenaSdk
 from kadena_sdk.key_pair import KeyPair
+from token_manifest import manifest_hash
+from gas_estimator import GasEstimator, template_key
 
-import boto3
-from botocore.exceptions import ClientError
+# boto3 is provided by the lambda runtime, so it isn't bundled, and it
+# is only imported once a client is needed
 
 SECRET_NAME = os.environ['SECRET_NAME']
 BUCKET = os.environ['BUCKET']
@@ -15,102 +23,240 @@ CHAIN_ID = os.environ['CHAIN_ID']
 NFT_CONTRACT = os.environ['NFT_CONTRACT']
 POLICY_CONTRACT = os.environ['POLICY_CONTRACT']
 COLLECTION = os.environ['COLLECTION']
+# Seconds the secret, key pair and sdk are reused by warm invocations
+# before the secret is read again, so a rotated key is picked up
+SECRET_TTL = int(os.environ.get('SECRET_TTL', 3600))
+
+# Gas used by a single reveal-token call, and by the rest of the transaction.
+# Batches are packed so they stay under the chain's per transaction limit.
+# These are only used when the gas can't be measured with /local.
+REVEAL_GAS_PER_TOKEN = 2500
+REVEAL_BASE_GAS = 500
+MAX_BATCH_GAS = 150000
+
+# Queue entries read per get-pending-reveals call
+PENDING_PAGE_SIZE = 100
+
+# Concurrency of the reveal pipeline stages, and the size of the
+# connection pools shared by the threads of each stage.
+S3_CONCURRENCY = 32
+CHAIN_CONCURRENCY = 8
+# Signed commands posted per /send request
+SEND_CHUNK_SIZE = 10
+
+_s3_client = None
+_chain_session = None
+_gas_estimator = None
+_kadena = None
+_kadena_loaded = 0
+# Token ids that can't be revealed, with why. They stay pending in the
+# queue, so warm invocations skip them instead of finding them again.
+_failed_tokens = {}
+
+
+def get_s3_client():
+  """A single S3 client shared by all the pipeline threads.
+  boto3 clients are thread safe, the pool is sized for the stage."""
+  global _s3_client
+  if _s3_client is None:
+    import boto3
+    from botocore.config import Config
+    _s3_client = boto3.client('s3', 
+      region_name=REGION,
+      config=Config(max_pool_connections=S3_CONCURRENCY))
+  return _s3_client
+
+
+def get_chain_session():
+  """A keep-alive session for posting to the chainweb node."""
+  global _chain_session
+  if _chain_session is None:
+    _chain_session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+      pool_connections=CHAIN_CONCURRENCY,
+      pool_maxsize=CHAIN_CONCURRENCY)
+    _chain_session.mount('https://', adapter)
+    _chain_session.mount('http://', adapter)
+  return _chain_session
+
+
+def get_gas_estimator():
+  """Kept between warm invocations, so gas is only measured again
+  once an estimate is stale."""
+  global _gas_estimator
+  if _gas_estimator is None:
+    _gas_estimator = GasEstimator(max_gas=MAX_BATCH_GAS)
+  return _gas_estimator
+
+
+def run_stage(name, fn, items, workers):
+  """Runs fn over items on a bounded thread pool, keeping the order
+  of the results, and logs how long the stage took."""
+  start = time.perf_counter()
+  if len(items) == 0:
+    results = []
+  else:
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+      results = list(executor.map(fn, items))
+  print(f'[{name}] {len(items)} items in {time.perf_counter() - start:.3f}s')
+  return results
 
 def get_secret():
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-      service_name='secretsmanager',
-      region_name=REGION
-    )
-
-    try:
-      get_secret_value_response = client.get_secret_value(
-        SecretId=SECRET_NAME
-      )
-    except ClientError as e:
-        # For a list of exceptions thrown, see
-        # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
-        raise e
-
-    # Decrypts secret using the associated KMS key.
-    secret = get_secret_value_response['SecretString']
-
-    # Your code goes here.
-    return secret
-
-
-def get_minted_nfts(kadena):
-  payload = {
-    "exec": {
-      "data": {},
-      "code": f'({NFT_CONTRACT}.get-unrevealed-tokens-for-collection "{COLLECTION}")'
+  """Reads the key pair json from Secrets Manager."""
+  import boto3
+  client = boto3.client('secretsmanager', region_name=REGION)
+  return client.get_secret_value(SecretId=SECRET_NAME)['SecretString']
+
+
+def get_kadena():
+  """The sdk, signing with the key pair from the secret. Kept between
+  warm invocations, building it reads the secret and the node's /config.
+  Returns (kadena, refreshed)."""
+  global _kadena, _kadena_loaded
+  if _kadena is not None and time.time() - _kadena_loaded < SECRET_TTL:
+    return _kadena, False
+
+  pub_priv_key = json.loads(get_secret())
+  kp = KeyPair(type='json', 
+    priv_key=pub_priv_key['priv_key'],
+    pub_key=pub_priv_key['pub_key'])
+  _kadena = KadenaSdk(key_pair=kp, base_url=KADENA_NODE_URL)
+  _kadena_loaded = time.time()
+  return _kadena, True
+
+
+def local_command(kadena, cmd):
+  """Runs a command with /local over the shared session, so warm
+  invocations reuse the node connection."""
+  resp = get_chain_session().post(
+    kadena.build_url(kadena.LOCAL, cmd['meta']['chainId']),
+    json=sign_command(kadena, cmd))
+  return resp.json()
+
+
+def local_estimated(kadena, cmd):
+  """Runs a read with /local under a gas limit from the estimator.
+  The gas each read uses is folded back into the estimate, so it is only
+  preflighted on cold starts. A read that outgrows the estimate, e.g. a
+  page with more pending tokens, is run again at the max."""
+  estimator = get_gas_estimator()
+  key = template_key(cmd['payload']['exec']['code'])
+  cmd['meta']['gasLimit'] = estimator.estimate(cmd, lambda c: local_command(kadena, c), key)
+  resp = local_command(kadena, cmd)
+  if resp['result']['status'] != 'success' and 'Gas limit' in str(resp['result'].get('error')):
+    cmd['meta']['gasLimit'] = estimator.max_gas
+    resp = local_command(kadena, cmd)
+  if resp['result']['status'] == 'success':
+    estimator.observe(key, cmd['meta']['chainId'], resp['gas'])
+  return resp
+
+
+def get_minted_nfts(kadena, page_size=PENDING_PAGE_SIZE):
+  """Reads the collection's pending reveal queue a page at a time."""
+  minted_nfts = []
+  cursor = 0
+  while True:
+    payload = {
+      "exec": {
+        "data": {},
+        "code": f'({NFT_CONTRACT}.get-pending-reveals "{COLLECTION}" {cursor} {page_size})'
+      }
     }
-  }
 
-  cmd = kadena.build_command(payload, [CHAIN_ID], gas_limit=150000)
-  resp = kadena.local(cmd)
-  respJson = resp[CHAIN_ID].json()
-  return respJson['result']['data']
-
-
-def reveal_nft(kadena, minted_token, url, datum, send_local=False):
-    
-  # Get the hash of the token
-  minted_token['hash'] = kadena.run_pact('''
-    (let*
-      (
-        (uri (kip.token-manifest.uri (read-msg "scheme") (read-msg "data")))
-        (datum-complete (kip.token-manifest.create-datum uri (read-msg "datum")))
-        (manifest (kip.token-manifest.create-manifest uri [datum-complete]))
-      )
-      (at "hash" manifest)
-    )
-    ''',
-    env_data={
-      'scheme': 'https',
-      'data': url,
-      'datum': datum,
-    })['data']
-  
+    cmd = kadena.build_command(payload, [CHAIN_ID])[CHAIN_ID]
+    respJson = local_estimated(kadena, cmd)
+    page = respJson['result']['data']
+
+    minted_nfts.extend(page['tokens'])
+    if page['done']:
+      return minted_nfts
+    cursor = page['cursor']['int']
+
+
+def pack_reveal_batches(reveals, 
+  max_batch_gas=MAX_BATCH_GAS, 
+  gas_per_token=REVEAL_GAS_PER_TOKEN, 
+  base_gas=REVEAL_BASE_GAS):
+  """Groups reveals into batches that fit in one transaction's gas limit.
+  Returns a list of (reveals, gas_limit) tuples."""
+  per_batch = max(1, int((max_batch_gas - base_gas) // gas_per_token))
+  batches = []
+  for i in range(0, len(reveals), per_batch):
+    batch = reveals[i:i + per_batch]
+    batches.append((batch, min(math.ceil(base_gas + gas_per_token * len(batch)), max_batch_gas)))
+  return batches
+
+
+def measure_reveal_gas(kadena, reveals):
+  """Measures the (base, per token) gas of reveal-tokens with /local,
+  with the estimator's margin applied.
+  Falls back to the constants when the preflight fails."""
+  if not reveals:
+    return REVEAL_BASE_GAS, REVEAL_GAS_PER_TOKEN
+
+  estimator = get_gas_estimator()
+  def local(cmd):
+    return kadena.local({ CHAIN_ID: cmd })[CHAIN_ID].json()
+  try:
+    base, per_token = estimator.measure_batch('reveal-tokens', CHAIN_ID,
+      lambda n: build_reveal_command(kadena, reveals[:n], MAX_BATCH_GAS), 
+      len(reveals), local)
+  except Exception as e:
+    print(f'Reveal gas preflight failed, using the defaults: {e}')
+    return REVEAL_BASE_GAS, REVEAL_GAS_PER_TOKEN
+  return base * estimator.margin, per_token * estimator.margin
+
+
+def build_reveal_command(kadena, reveals, gas_limit):
+  """Builds the reveal-tokens command for a batch of tokens.
+  reveals is a list of (minted_token, url, datum) tuples."""
+  m_tokens = []
+  t_datas = []
+  clist = [
+    {
+      "name": "coin.GAS",
+      "args": []
+    },
+    {
+      "name": "free.nft-mint.OPS",
+      "args": []
+    },
+    {
+      "name": "free.nft-policy.OPS",
+      "args": []
+    },
+  ]
+  for minted_token, url, datum in reveals:
+    minted_token['hash'] = manifest_hash('https', url, datum)
+    m_tokens.append(minted_token)
+    t_datas.append({
+      "scheme": "https",
+      "data": url,
+      "datum": datum,
+    })
+    # MINT is managed, every token in the batch needs its own entry
+    clist.append({
+      'name': 'marmalade.ledger.MINT',
+      'args': [f't:{minted_token["hash"]}', minted_token["account"], 1]
+    })
+
   signers = [
     {
       "pubKey": kadena.key_pair.get_pub_key(),
-      "clist": [
-        {
-          "name": "coin.GAS",
-          "args": []
-        },
-        {
-          "name": "free.nft-mint.OPS",
-          "args": []
-        },
-        {
-          "name": "free.nft-policy.OPS",
-          "args": []
-        },
-        {
-          'name': 'marmalade.ledger.MINT',
-          'args': [f't:{minted_token["hash"]}', minted_token["account"], 1]
-        }
-      ]
-    }  
+      "clist": clist
+    }
   ]
-  
+
   payload = {
     "exec": {
       "data": {
-        "m-token": minted_token,
-        "t-token": {
-          "scheme": "https",
-          "data": url,
-          "datum": datum,
-        },
+        "m-tokens": m_tokens,
+        "t-datas": t_datas,
       },
       "code": f'''
-({NFT_CONTRACT}.reveal-token 
-  (read-msg "m-token") 
-  (read-msg "t-token")
+({NFT_CONTRACT}.reveal-tokens 
+  (read-msg "m-tokens") 
+  (read-msg "t-datas")
   0
   {POLICY_CONTRACT}
 )
@@ -118,48 +264,160 @@ def reveal_nft(kadena, minted_token, url, datum, send_local=False):
     }
   }
 
-  cmd = kadena.build_command(payload, [CHAIN_ID], signers=signers, gas_limit=2500, gas_price=1e-8)
-  if send_local:
-    resp = kadena.local(cmd)[CHAIN_ID]
-    return resp.json()
-  else:
-    return kadena.send(cmd)[CHAIN_ID].json()
+  return kadena.build_command(payload, [CHAIN_ID], signers=signers, gas_limit=gas_limit, gas_price=1e-8)[CHAIN_ID]
+
+
+def sign_command(kadena, command):
+  """Hashes and signs a command, returning it in the /send format."""
+  cmd_json = json.dumps(command)
+  hash_code, sig = kadena.hash_and_sign(cmd_json)
+  return {
+    'hash': hash_code,
+    'sigs': [] if sig is None else [{'sig': sig}],
+    'cmd': cmd_json,
+  }
+
+
+def preflight_reveals(kadena, reveals):
+  """Runs reveal-tokens for the reveals with /local, at the max gas so only
+  the tokens can make it fail. Returns the error, None if it succeeds."""
+  result = local_command(kadena, build_reveal_command(kadena, reveals, MAX_BATCH_GAS))['result']
+  return None if result['status'] == 'success' else result.get('error')
+
+
+def isolate_failed_reveals(kadena, reveals):
+  """One bad token fails its whole batch, and the next invocation would
+  pack the same batch again. Splits a batch that fails /local in halves
+  until the tokens that fail on their own are found.
+  Returns (reveals that pass, { token id: error } of those that don't)."""
+  error = preflight_reveals(kadena, reveals)
+  if error is None:
+    return reveals, {}
+  if len(reveals) == 1:
+    return [], { reveals[0][0]['token-id']['int']: error }
+  half = len(reveals) // 2
+  passed, failed = isolate_failed_reveals(kadena, reveals[:half])
+  passed_rest, failed_rest = isolate_failed_reveals(kadena, reveals[half:])
+  return passed + passed_rest, { **failed, **failed_rest }
+
+
+def submit_commands(kadena, signed_cmds):
+  """Posts signed commands to /send over the shared session."""
+  resp = get_chain_session().post(
+    kadena.build_url(kadena.SEND, CHAIN_ID), 
+    json={'cmds': signed_cmds})
+  return resp.json()
+
+
+def fetch_token_metadata(id):
+  """Reads the token's json file from the bucket."""
+  marm_token_file = get_s3_client().get_object(Bucket=BUCKET, Key=f'{id}.json')
+  return json.loads(marm_token_file['Body'].read().decode('utf-8'))
+
+
+def try_fetch_token_metadata(id):
+  """Returns (metadata, None), or (None, error) if it can't be read."""
+  try:
+    return fetch_token_metadata(id), None
+  except Exception as e:
+    return None, repr(e)
+
+
+def tag_object_revealed(key):
+  """Tags an object so the bucket policy makes it public."""
+  get_s3_client().put_object_tagging(
+    Bucket=BUCKET,
+    Key=key,
+    Tagging={'TagSet': [{'Key': 'revealed', 'Value': 'yes'}]}
+  )
+
+
+def timed(timings, name, fn, *args):
+  """Calls fn, recording how long it took in timings."""
+  start = time.perf_counter()
+  result = fn(*args)
+  timings[name] = time.perf_counter() - start
+  return result
+
+
+def log_timings(timings):
+  print('[timings] ' + ' '.join(f'{name}={seconds:.3f}s' for name, seconds in timings.items()))
+
 
 def lambda_handler(event, context):
-    pub_priv_key = json.loads(get_secret())
-
-    kp = KeyPair(type='json', 
-      priv_key=pub_priv_key['priv_key'],
-      pub_key=pub_priv_key['pub_key'])
-    kadena = KadenaSdk(key_pair=kp, base_url=KADENA_NODE_URL)
-
-    minted_nfts = get_minted_nfts(kadena)
-
-    for minted_nft in minted_nfts:
-      # Get the token id from the minted nft
-      id = minted_nft['token-id']['int']
-
-      # From the s3 bucket, get the json file, and reveal the image
-      s3 = boto3.client('s3')
-      marm_token_file = s3.get_object(Bucket=BUCKET, Key=f'{id}.json')
-      marm_token_datum = json.loads(marm_token_file['Body'].read().decode('utf-8'))
-      s3.put_object_tagging(
-        Bucket=BUCKET,
-        Key=f'{id}.gif',
-        Tagging={'TagSet': [{'Key': 'revealed', 'Value': 'yes'}]}
-      )
-      s3.put_object_tagging(
-        Bucket=BUCKET,
-        Key=f'{id}.json',
-        Tagging={'TagSet': [{'Key': 'revealed', 'Value': 'yes'}]}
-      )
-      url = f'{BUCKET}.s3.{REGION}.amazonaws.com/{id}.gif'
-
-      # Reveal the nft
-      print('')
-      print(reveal_nft(kadena, minted_nft, url, marm_token_datum, send_local=False))
+    global _cold
+    start = time.perf_counter()
+    # The init phase is only paid by the first invocation of an environment
+    timings = { 'init': _INIT_SECONDS } if _cold else {}
+    _cold = False
+
+    kadena, refreshed = timed(timings, 'setup', get_kadena)
+    print(f'[setup] {"secret read" if refreshed else "cached"}')
+
+    minted_nfts = timed(timings, 'pending', get_minted_nfts, kadena)
+    minted_nfts = [minted_nft for minted_nft in minted_nfts 
+      if minted_nft['token-id']['int'] not in _failed_tokens]
+    if not minted_nfts:
+      timings['handler'] = time.perf_counter() - start
+      log_timings(timings)
+      return {
+        'statusCode': 200,
+        'body': json.dumps('nothing to reveal')
+      }
+    # Get the token id from the minted nft
+    ids = [minted_nft['token-id']['int'] for minted_nft in minted_nfts]
 
+    # From the s3 bucket, get the json files
+    fetched = timed(timings, 'fetch', run_stage, 
+      'fetch', try_fetch_token_metadata, ids, S3_CONCURRENCY)
+    failed = { id: error for id, (_, error) in zip(ids, fetched) if error is not None }
+
+    reveals = [
+      (minted_nft, f'{BUCKET}.s3.{REGION}.amazonaws.com/{id}.gif', datum)
+      for minted_nft, id, (datum, _) in zip(minted_nfts, ids, fetched)
+      if id not in failed
+    ]
+
+    # Take out the tokens that would fail their batch, they are logged and
+    # left in the queue so the rest keep being revealed
+    checked = timed(timings, 'preflight', run_stage, 'preflight', 
+      lambda b: isolate_failed_reveals(kadena, b[0]), pack_reveal_batches(reveals), CHAIN_CONCURRENCY)
+    reveals = [reveal for passed, _ in checked for reveal in passed]
+    for _, batch_failed in checked:
+      failed.update(batch_failed)
+    for id, error in failed.items():
+      print(f'[skip] token {id}: {error}')
+    _failed_tokens.update(failed)
+
+    # Reveal the nfts, many per transaction
+    base_gas, gas_per_token = timed(timings, 'gas', measure_reveal_gas, kadena, reveals)
+    print(f'Reveal gas: {base_gas:.0f} base, {gas_per_token:.0f} per token')
+    batches = pack_reveal_batches(reveals, MAX_BATCH_GAS, gas_per_token, base_gas)
+
+    # Make the images of the tokens being revealed public
+    keys = [f'{reveal[0]["token-id"]["int"]}.{ext}' for reveal in reveals for ext in ('gif', 'json')]
+    timed(timings, 'tag', run_stage, 'tag', tag_object_revealed, keys, S3_CONCURRENCY)
+
+    cmds = run_stage('hash', 
+      lambda b: build_reveal_command(kadena, b[0], b[1]), batches, CHAIN_CONCURRENCY)
+    signed_cmds = run_stage('sign', 
+      lambda c: sign_command(kadena, c), cmds, CHAIN_CONCURRENCY)
+    chunks = [signed_cmds[i:i + SEND_CHUNK_SIZE] 
+      for i in range(0, len(signed_cmds), SEND_CHUNK_SIZE)]
+    results = timed(timings, 'submit', run_stage, 'submit', 
+      lambda c: submit_commands(kadena, c), chunks, CHAIN_CONCURRENCY)
+
+    for result in results:
+      print(result)
+
+    timings['handler'] = time.perf_counter() - start
+    log_timings(timings)
     return {
         'statusCode': 200,
         'body': json.dumps('success')
     }
+
+
+_cold = True
+_INIT_SECONDS = time.perf_counter() - _INIT_START
+print(f'[init] {_INIT_SECONDS:.3f}s')
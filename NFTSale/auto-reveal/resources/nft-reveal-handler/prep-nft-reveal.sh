@@ -1,9 +1,18 @@
-
 rm function.zip
 rm -rf python
 mkdir python
-pip install -r requirements.txt --platform manylinux2014_x86_64 --only-binary=:all: --no-binary=:none: -t ./python
+# --no-compile: the lambda runtime's python may not match this one, so
+# the bytecode would be ignored and only make the zip bigger
+pip install -r requirements.txt --platform manylinux2014_x86_64 --only-binary=:all: --no-binary=:none: --no-compile -t ./python
+# boto3 comes with the lambda runtime, package metadata and tests aren't
+# needed to run, and smaller zips unpack faster on cold starts
+rm -rf python/boto3 python/botocore python/s3transfer python/bin
+rm -rf python/*.dist-info python/kadena_sdk/tests
 cd python
-zip -r9 ../function.zip .
+zip -r9 ../function.zip . -x '*/__pycache__/*'
 cd ..
-zip -g function.zip lambda_function.py
\ No newline at end of file
+# Every module next to the handler, so new imports are always bundled,
+# and the modules shared with the scripts, from their only copy
+zip -g function.zip *.py
+zip -gj function.zip ../../../scripts/token_manifest.py ../../../../scripts/gas_estimator.py
+du -h function.zip
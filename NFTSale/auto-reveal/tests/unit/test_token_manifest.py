@@ -0,0 +1,66 @@
+import os
+import sys
+
+sys.path.append(os.path.join(
+  os.path.dirname(__file__), '..', '..', '..', 'scripts'))
+
+from token_manifest import create_datum, create_manifest, manifest_hash, uri
+
+# Produced by kip.token-manifest, see contracts/token-manifest.repl.
+# The first one is also the revealed token id in contracts/nft-mint.repl.
+GOLDEN_VECTORS = [
+  (
+    'https',
+    'abc',
+    { 'name': 't', 'description': 't' },
+    'EYzhXCEI8mVGhrTnrE48QKJYBgh6DGfgpiGmTRT-nH4',
+  ),
+  (
+    'https',
+    'bucket.s3.us-west-2.amazonaws.com/1.gif',
+    {
+      'name': 'Kadena Artwork #1',
+      'description': 'The first piece',
+      'image': '1.gif',
+      'edition': 1,
+      'attributes': [
+        { 'trait_type': 'Background', 'value': 'Pink' },
+        { 'trait_type': 'Hash Rate', 'value': 5 },
+      ],
+    },
+    '6DR40SSuQ4S6tZ0_vBBkX3o4l299kFpoy1jDpRGIjSw',
+  ),
+  (
+    'ipfs',
+    'QmYwAPJzv5CZsnA625s3Xf2nemtYgPpHdWEz79ojWnPbdG',
+    { 'name': 'Decimal', 'rarity': 0.25, 'revealed': True, 'tags': [] },
+    'zKIyJH0Ajf0P8yGlNavPArFxoPncN5k7i8y8g50OmVE',
+  ),
+]
+
+
+def test_manifest_hash_matches_pact():
+  for scheme, data, datum, expected in GOLDEN_VECTORS:
+    assert manifest_hash(scheme, data, datum) == expected
+
+
+def test_key_order_does_not_matter():
+  scheme, data, datum, expected = GOLDEN_VECTORS[1]
+  reordered = dict(reversed(list(datum.items())))
+  assert manifest_hash(scheme, data, reordered) == expected
+
+
+def test_integral_floats_hash_as_integers():
+  # JSON metadata read as 5.0 reaches pact as the integer 5
+  scheme, data, datum, expected = GOLDEN_VECTORS[1]
+  datum = dict(datum, edition=1.0)
+  assert manifest_hash(scheme, data, datum) == expected
+
+
+def test_create_manifest_shape():
+  token_uri = uri('https', 'abc')
+  datum = create_datum(token_uri, { 'name': 't', 'description': 't' })
+  manifest = create_manifest(token_uri, [datum])
+  assert manifest['uri'] == { 'scheme': 'https', 'data': 'abc' }
+  assert manifest['data'] == [datum]
+  assert manifest['hash'] == GOLDEN_VECTORS[0][3]
@@ -1,95 +1,128 @@
 import os
 import json
-from kadena_sdk import *
+import time
 import argparse
+from functools import partial
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+from kadena_sdk import *
+
+from token_manifest import manifest_hash
+
 
-# Use arguments to get the path to the directory
-# and the directory to put the hashes in
-argparser = argparse.ArgumentParser()
-argparser.add_argument('-p', help='Path to the directory')
-argparser.add_argument('-b', help='The aws bucket url')
-argparser.add_argument('-o', help='Directory to put the hashes in')
-args = argparser.parse_args()
+def token_index(filename):
+  return int(filename.split('.')[0])
+
+
+def list_token_files(path):
+  """Returns the json files in the directory, sorted by token index."""
+  with os.scandir(path) as it:
+    filelist = [e.name for e in it if e.is_file() and e.name.endswith('.json')]
+  filelist.sort(key=token_index)
+  return filelist
+
+
+def hash_token_file(path, bucket):
+  """Hashes a metadata file the same way the reveal lambda does,
+  so the provenance matches the tokens created on chain."""
+  with open(path, 'r') as f:
+    datum = json.loads(f.read())
+  index = token_index(os.path.basename(path))
+  return manifest_hash('https', os.path.join(bucket, f'{index}.gif'), datum)
 
-hashes = []
 
-breaker = 0
+def hash_chunk(chunk, bucket):
+  """Worker entry point. Hashes a list of (index, path) pairs."""
+  return [(index, hash_token_file(path, bucket)) for index, path in chunk]
 
-filelist = os.listdir(args.p)
-# Filter our the non json files
-filelist = list(filter(lambda x: x.endswith('.json'), filelist))
-# Sort the files based on their number
-filelist.sort(key=lambda x: int(x.split('.')[0]))
 
+def chunked(items, size):
+  it = iter(items)
+  while True:
+    chunk = list(islice(it, size))
+    if not chunk:
+      return
+    yield chunk
 
-kda = KadenaSdk()
 
-def create_token_datum(file_data):
-  return {
-    'file_hash': blake_hash(file_data),
-  }
+def read_checkpoint(path):
+  """Reads the hashes already written by an interrupted run.
+  A torn last line from a crash is ignored."""
+  done = {}
+  if not os.path.exists(path):
+    return done
 
-# Loop through each json file in a directory
-for filename in filelist:
-  path = os.path.join(args.p, filename)
-  
-  # Open the file
   with open(path, 'r') as f:
-    # Load the json file
-    file_data = f.read()
-    token_datum = create_token_datum(file_data)
-    bucket_path = os.path.join(args.b, token_datum['image'])
-    uri = {
-      "data": bucket_path,
-      "scheme": "https",
-    }
-    datum = {
-      "hash": blake_hash({ "data": [blake_hash(token_datum)], "uri": uri}),
-      "uri": uri,
-      "datum": token_datum
-    }
-    manifest = {
-      "hash": blake_hash({ "data": [datum['hash']], "uri": uri}),
-      "uri": uri,
-      "data": [
-        datum
-      ]
-    }
-    # Print the hash
-    
-
-#     pact_data = kda.run_pact('''
-# (let*
-#   (
-#     (uri (kip.token-manifest.uri (read-msg "scheme") (read-msg "data")))
-#     (datum-complete (kip.token-manifest.create-datum uri (read-msg "datum")))
-#     (manifest (kip.token-manifest.create-manifest uri [datum-complete]))
-#     (token-id (concat ["t:" (at "hash" manifest)]))
-#   )
-#   manifest
-# )
-# ''', env_data={
-#   'scheme': 'https',
-#   'data': 'https://s3/' + token_datum['image'],
-#   'datum': token_datum
-# })['data']
-
-#     # print(manifest['data'])
-#     # print(pact_data['data'])
-    
-#     print(DeepDiff(manifest, pact_data))
-
-#     assert(manifest['hash'] == pact_data['hash'])
-
-    print(manifest['uri'])
-    hashes.append(manifest['hash'])
-    
-  # breaker += 1
-  # if breaker > 10:
-  #   break
-
-with open(os.path.join(args.o), 'w') as f:
-  json.dump({ 
-    'hashes': hashes, 
-    'provenance': blake_hash({'hashes': hashes})
-  }, f, indent=2)
\ No newline at end of file
+    for line in f:
+      parts = line.strip().split(',')
+      if len(parts) == 2 and len(parts[1]) == 43:
+        done[int(parts[0])] = parts[1]
+  return done
+
+
+def generate(path, bucket, output, workers=1, chunk_size=256):
+  filelist = list_token_files(path)
+  checkpoint_path = f'{output}.checkpoint'
+  done = read_checkpoint(checkpoint_path)
+  todo = [
+    (token_index(f), os.path.join(path, f))
+    for f in filelist if token_index(f) not in done
+  ]
+  if done:
+    print(f'Resuming from checkpoint, {len(done)} of {len(filelist)} files already hashed')
+
+  start = time.time()
+  hashed = 0
+  with open(checkpoint_path, 'a') as checkpoint:
+    if workers > 1:
+      executor = ProcessPoolExecutor(max_workers=workers)
+      # map returns chunks in submission order, so results stay in token order
+      results = executor.map(partial(hash_chunk, bucket=bucket),
+        chunked(todo, chunk_size))
+    else:
+      executor = None
+      results = (hash_chunk(c, bucket) for c in chunked(todo, chunk_size))
+
+    try:
+      for chunk_result in results:
+        for index, token_hash in chunk_result:
+          checkpoint.write(f'{index},{token_hash}\n')
+          done[index] = token_hash
+        checkpoint.flush()
+
+        hashed += len(chunk_result)
+        elapsed = time.time() - start
+        print(f'{len(done)}/{len(filelist)} files, '
+          f'{hashed / elapsed if elapsed > 0 else 0:.1f} files/sec')
+    finally:
+      if executor:
+        executor.shutdown(cancel_futures=True)
+
+  hashes = [done[token_index(f)] for f in filelist]
+  with open(output, 'w') as f:
+    json.dump({
+      'hashes': hashes,
+      'provenance': blake_hash({'hashes': hashes})
+    }, f, indent=2)
+  os.remove(checkpoint_path)
+
+  elapsed = time.time() - start
+  print(f'Hashed {hashed} files in {elapsed:.2f}s '
+    f'({hashed / elapsed if elapsed > 0 else 0:.1f} files/sec)')
+
+
+if __name__ == '__main__':
+  # Use arguments to get the path to the directory
+  # and the directory to put the hashes in
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('-p', help='Path to the directory')
+  argparser.add_argument('-b', help='The aws bucket url')
+  argparser.add_argument('-o', help='Directory to put the hashes in')
+  argparser.add_argument('-w', type=int, default=os.cpu_count(),
+    help='Number of worker processes, 1 hashes on the main process')
+  argparser.add_argument('-c', type=int, default=256,
+    help='Files per chunk sent to a worker')
+  args = argparser.parse_args()
+
+  generate(args.p, args.b, args.o, workers=args.w, chunk_size=args.c)
@@ -0,0 +1,141 @@
+"""Local implementation of the kip.token-manifest hashing functions.
+
+Mirrors `uri`, `create-datum` and `create-manifest` from
+kda-env/marmalade/manifest.pact so token hashes can be computed without
+a /local round trip to the chain.
+
+Pact hashes objects by blake2b hashing their JSON encoding, and that
+encoding is not plain sorted JSON: integers are wrapped as {"int": n} and
+object keys come out in the order of the HashMap Pact used to encode them.
+`pact_json` reproduces both so the hashes match what the chain computes.
+
+The reveal lambda imports it too, prep-nft-reveal.sh and app.py copy it
+into the lambda bundle.
+"""
+from decimal import Decimal
+
+from kadena_sdk import blake_hash
+
+_MASK_64 = (1 << 64) - 1
+_FNV_PRIME = 16777619
+_HASHABLE_SALT = 0xdc36d1615b7400a4
+_SAFE_INTEGER = 2 ** 53
+
+
+def _key_hash(key):
+  """The hash Pact's object encoder uses for a key (hashable-1.3 FNV-1
+  over the UTF-16 text, salted with the text length)."""
+  data = key.encode('utf-16-le')
+  h = ((_HASHABLE_SALT * _FNV_PRIME) ^ (len(data) // 2)) & _MASK_64
+  for byte in data:
+    h = ((h * _FNV_PRIME) ^ byte) & _MASK_64
+  return h
+
+
+def _key_order(key):
+  """HashMap iteration order: 5 bit chunks of the hash, lowest first."""
+  h = _key_hash(key)
+  return [(h >> shift) & 0x1f for shift in range(0, 64, 5)], key
+
+
+def _encode_string(s):
+  out = ['"']
+  for c in s:
+    if c == '"':
+      out.append('\\"')
+    elif c == '\\':
+      out.append('\\\\')
+    elif c == '\n':
+      out.append('\\n')
+    elif c == '\r':
+      out.append('\\r')
+    elif c == '\t':
+      out.append('\\t')
+    elif ord(c) < 0x20:
+      out.append(f'\\u{ord(c):04x}')
+    else:
+      out.append(c)
+  out.append('"')
+  return ''.join(out)
+
+
+def _encode_decimal(value):
+  """Encodes a non integral decimal the way Pact does: a JSON number when
+  the mantissa is a safe integer, otherwise {"decimal": "..."}."""
+  d = Decimal(repr(value)) if isinstance(value, float) else value
+  sign, digits, exponent = d.normalize().as_tuple()
+  mantissa = int(''.join(map(str, digits)))
+  if mantissa >= _SAFE_INTEGER:
+    return '{"decimal":' + _encode_string(str(d)) + '}'
+
+  # Same rules as Haskell's Generic scientific formatting
+  e = len(digits) + exponent
+  prefix = '-' if sign else ''
+  ds = ''.join(map(str, digits))
+  if 0 <= e <= 7:
+    whole, frac = ds[:e].ljust(e, '0') or '0', ds[e:] or '0'
+    return f'{prefix}{whole}.{frac}'
+  return f'{prefix}{ds[0]}.{ds[1:] or "0"}e{e - 1}'
+
+
+def pact_json(value):
+  """Serializes a value the way Pact does before hashing it."""
+  if value is None:
+    return 'null'
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  if isinstance(value, (float, Decimal)) and value == int(value):
+    # JSON numbers without a fractional part are read as integers
+    value = int(value)
+  if isinstance(value, int):
+    return '{"int":' + str(value) + '}'
+  if isinstance(value, (float, Decimal)):
+    return _encode_decimal(value)
+  if isinstance(value, str):
+    return _encode_string(value)
+  if isinstance(value, (list, tuple)):
+    return '[' + ','.join(pact_json(v) for v in value) + ']'
+  if isinstance(value, dict):
+    keys = sorted(value.keys(), key=_key_order)
+    return '{' + ','.join(
+      f'{_encode_string(k)}:{pact_json(value[k])}' for k in keys) + '}'
+
+  raise Exception(f'Invalid type: {type(value)}')
+
+
+def pact_hash(value):
+  """Equivalent of the pact `hash` native."""
+  if isinstance(value, str):
+    return blake_hash(value)
+  return blake_hash(pact_json(value))
+
+
+def uri(scheme, data):
+  return { 'scheme': scheme, 'data': data }
+
+
+def hash_contents(uri, hashes):
+  return pact_hash({ 'uri': uri, 'data': hashes })
+
+
+def create_datum(uri, datum):
+  return {
+    'uri': uri,
+    'hash': hash_contents(uri, [pact_hash(datum)]),
+    'datum': datum,
+  }
+
+
+def create_manifest(uri, data):
+  return {
+    'uri': uri,
+    'hash': hash_contents(uri, [d['hash'] for d in data]),
+    'data': data,
+  }
+
+
+def manifest_hash(scheme, data, datum):
+  """Hash of a single datum manifest, as built by nft-mint's
+  create-marmalade-token. The marmalade token id is `t:<hash>`."""
+  token_uri = uri(scheme, data)
+  return create_manifest(token_uri, [create_datum(token_uri, datum)])['hash']
@@ -0,0 +1,362 @@
+import os
+import json
+import time
+import argparse
+from collections import deque
+from decimal import Decimal, ROUND_DOWN
+
+from kadena_sdk.kadena_sdk import KadenaSdk
+from kadena_sdk.key_pair import KeyPair
+
+from fanout import chunked, create_session, sign_command
+from gas_estimator import GasEstimator
+
+AIRDROP_CONTRACT = 'free.airdrop'
+
+MAINNET = {
+  'base_url': 'https://api.chainweb.com',
+  'chain_id': '1',
+}
+TESTNET = {
+  'base_url': 'https://api.testnet.chainweb.com',
+  'chain_id': '1',
+}
+NETWORK = TESTNET
+# KADENA_NODE_URL points the script at another node, e.g. local_chainweb.py
+BASE_URL = os.environ.get('KADENA_NODE_URL', NETWORK['base_url'])
+
+# Chainweb won't accept a transaction above the block gas limit
+MAX_GAS_LIMIT = 150000
+# Chunk sizes used to measure the fixed and per recipient gas
+PROBE_SIZES = (10, 50)
+# Chunks sent but not yet confirmed
+WINDOW = 8
+POLL_INTERVAL = 5
+# Seconds to wait for a chunk before leaving it for the next run to check
+CONFIRM_TIMEOUT = 900
+# Seconds past a chunk's TTL before it is taken as never mined,
+# blocks are validated against their creation time, not the clock
+EXPIRY_MARGIN = 300
+
+
+def pact_decimal(amount):
+  """Formats a decimal as a pact decimal literal (always has a '.')."""
+  s = format(Decimal(amount), 'f')
+  return s if '.' in s else f'{s}.0'
+
+
+def read_recipients(path):
+  """One account per line, blank lines and # comments are skipped.
+  Duplicates are dropped, the journal tracks recipients by account."""
+  recipients = []
+  seen = set()
+  with open(path, 'r') as f:
+    for line in f:
+      account = line.strip()
+      if not account or account.startswith('#') or account in seen:
+        continue
+      seen.add(account)
+      recipients.append(account)
+  return recipients
+
+
+# -------------------------------
+# Journal
+
+def read_journal(path):
+  """Replays the journal of a previous run.
+  Returns the recipients already paid and the chunks that were sent,
+  or were about to be, but never confirmed, as
+  { request_key: (recipients, signed command) }.
+  Expired chunks are neither, their recipients are sent again.
+  A torn last line from a crash is ignored."""
+  paid = set()
+  outstanding = {}
+  if not os.path.exists(path):
+    return paid, outstanding
+
+  with open(path, 'r') as f:
+    for line in f:
+      try:
+        entry = json.loads(line)
+      except json.JSONDecodeError:
+        continue
+      if entry['event'] == 'sent':
+        outstanding[entry['requestKey']] = (entry['recipients'], entry.get('cmd'))
+      elif entry['event'] == 'confirmed':
+        recipients, _ = outstanding.pop(entry['requestKey'], ([], None))
+        if entry['status'] == 'success':
+          paid.update(recipients)
+      elif entry['event'] == 'expired':
+        outstanding.pop(entry['requestKey'], None)
+  return paid, outstanding
+
+
+def append_journal(journal, entry):
+  """Entries are flushed to disk before moving on. Chunks are journaled
+  before they are sent, so a crash never loses a chunk the node may
+  have accepted."""
+  journal.write(json.dumps(entry) + '\n')
+  journal.flush()
+  os.fsync(journal.fileno())
+
+
+# -------------------------------
+# Commands
+
+def build_airdrop_command(sdk, drop, recipients, gas_limit):
+  """Builds an airdrop-coin or airdrop-nft command for a chunk of recipients.
+  The recipients are passed as data so the code stays small."""
+  amount = pact_decimal(drop['amount'])
+  total = drop['amount'] * len(recipients)
+  sender = drop['sender']
+  managed = drop['managed_account']
+
+  if drop['type'] == 'nft':
+    code = (f'({AIRDROP_CONTRACT}.airdrop-nft "{sender}" "{managed}" '
+      f'{drop["token"]} "{drop["token_id"]}" {amount} (read-msg "recipients"))')
+    transfer_args = [drop['token_id'], sender, managed, float(total)]
+  else:
+    code = (f'({AIRDROP_CONTRACT}.airdrop-coin "{sender}" "{managed}" '
+      f'{drop["token"]} {amount} (read-msg "recipients"))')
+    transfer_args = [sender, managed, float(total)]
+
+  payload = {
+    "exec": {
+      "data": { "recipients": recipients },
+      "code": code,
+    }
+  }
+  signers = [
+    {
+      "pubKey": sdk.key_pair.get_pub_key(),
+      "clist": [
+        { "name": "coin.GAS", "args": [] },
+        { "name": f"{drop['token']}.TRANSFER", "args": transfer_args },
+        { "name": f"{AIRDROP_CONTRACT}.MANAGED", "args": [managed] },
+      ]
+    }
+  ]
+  chain_id = drop['chain_id']
+  return sdk.build_command(payload, [chain_id], signers, gas_limit=gas_limit)[chain_id]
+
+
+def local(sdk, session, cmd):
+  """Runs a command with /local, for the gas estimator."""
+  resp = session.post(sdk.build_url(sdk.LOCAL, cmd['meta']['chainId']),
+    json=sign_command(sdk, cmd))
+  resp.raise_for_status()
+  return resp.json()
+
+
+def size_chunks(sdk, session, estimator, drop, recipients):
+  """Measures the base and per recipient gas with /local preflights
+  and derives how many recipients fit in a transaction.
+  Returns the chunk size and a function giving a chunk's gas limit."""
+  base, per_recipient = estimator.measure_batch(drop_key(drop), drop['chain_id'],
+    lambda n: build_airdrop_command(sdk, drop, recipients[:n], MAX_GAS_LIMIT),
+    len(recipients), lambda cmd: local(sdk, session, cmd), sizes=PROBE_SIZES)
+  chunk_size = estimator.batch_size(base, per_recipient)
+  print(f'Measured {base:.0f} base gas and {per_recipient:.1f} gas per recipient, '
+    f'{chunk_size} recipients per chunk')
+
+  def gas_limit(n):
+    # Picks up the gas of mined chunks fed back with observe_batch
+    entry = estimator.batches[(drop_key(drop), drop['chain_id'])]
+    return estimator.batch_limit(entry['base'], entry['per_item'], n)
+  return chunk_size, gas_limit
+
+
+def drop_key(drop):
+  return f'airdrop-{drop["type"]}-{drop["token"]}'
+
+
+def expires_at(signed):
+  """When a signed command's TTL runs out, None for journals
+  written before the commands were kept."""
+  if signed is None:
+    return None
+  meta = json.loads(signed['cmd'])['meta']
+  return meta['creationTime'] + meta['ttl']
+
+
+# -------------------------------
+# Sending and confirming
+
+def send_chunks(sdk, session, chain_id, signed_cmds):
+  """Posts every chunk in one /send call, returns their request keys."""
+  resp = session.post(sdk.build_url(sdk.SEND, chain_id), json={'cmds': signed_cmds})
+  if resp.status_code != 200:
+    raise Exception(f'Send failed: {resp.text}')
+  return resp.json()['requestKeys']
+
+
+def resend_chunks(sdk, session, chain_id, outstanding):
+  """Sends the journaled commands of unconfirmed chunks again, in case the
+  last run stopped before the node got them. A command keeps its request
+  key, so one that was already accepted can't pay its recipients twice,
+  the node just rejects the duplicate. Expired commands are skipped,
+  the node won't take them anymore."""
+  for key, (_, signed) in outstanding.items():
+    if signed is None or expires_at(signed) < time.time():
+      continue
+    try:
+      send_chunks(sdk, session, chain_id, [signed])
+    except Exception as e:
+      print(f'Chunk {key} not resent: {e}')
+
+
+def poll(sdk, session, chain_id, request_keys):
+  """Returns the results of the request keys that have been mined."""
+  resp = session.post(sdk.build_url('/poll', chain_id),
+    json={'requestKeys': request_keys})
+  resp.raise_for_status()
+  return resp.json()
+
+
+def confirm(sdk, session, chain_id, journal, in_flight, stats, on_success=None):
+  """Polls every chunk in flight at once and journals the ones that finished.
+  on_success is called with the recipients and result of successful chunks.
+  A chunk /poll doesn't know once its TTL has passed can't be mined anymore,
+  it is journaled as expired so a rerun sends its recipients again."""
+  polled_at = time.time()
+  results = poll(sdk, session, chain_id, list(in_flight.keys()))
+  for key, result in results.items():
+    recipients, _, _ = in_flight.pop(key)
+    status = result['result']['status']
+    entry = { 'event': 'confirmed', 'requestKey': key, 'status': status }
+    if status == 'success':
+      stats['paid'] += len(recipients)
+      if on_success:
+        on_success(recipients, result)
+    else:
+      entry['error'] = result['result'].get('error')
+      stats['failed'] += len(recipients)
+      print(f'Chunk {key} failed: {entry["error"]}')
+    append_journal(journal, entry)
+
+  now = time.time()
+  for key, (recipients, sent_at, expiry) in list(in_flight.items()):
+    if expiry is not None and polled_at > expiry + EXPIRY_MARGIN:
+      in_flight.pop(key)
+      append_journal(journal, { 'event': 'expired', 'requestKey': key })
+      stats['expired'] += len(recipients)
+      print(f'Chunk {key} expired without being mined')
+    elif now - sent_at > CONFIRM_TIMEOUT:
+      # Left as sent in the journal, the next run checks it before resending
+      in_flight.pop(key)
+      stats['unconfirmed'] += len(recipients)
+      print(f'Chunk {key} not confirmed after {CONFIRM_TIMEOUT}s')
+
+
+def run_airdrop(sdk, drop, recipients, journal_path, window=WINDOW):
+  chain_id = drop['chain_id']
+  session = create_session(window)
+  # Gas measured by earlier runs is kept next to the journal
+  gas_path = f'{journal_path}.gas'
+  estimator = GasEstimator(max_gas=MAX_GAS_LIMIT)
+  if os.path.exists(gas_path):
+    estimator.load(gas_path)
+  stats = { 'paid': 0, 'failed': 0, 'unconfirmed': 0, 'expired': 0 }
+  start = time.time()
+
+  paid, outstanding = read_journal(journal_path)
+  with open(journal_path, 'a') as journal:
+    # Chunks from a previous run that were never confirmed
+    # have to be checked before their recipients are retried
+    if outstanding:
+      print(f'Checking {len(outstanding)} unconfirmed chunks from the last run')
+      resend_chunks(sdk, session, chain_id, outstanding)
+      in_flight = {
+        key: (r, time.time(), expires_at(signed)) for key, (r, signed) in outstanding.items()
+      }
+      while in_flight:
+        confirm(sdk, session, chain_id, journal, in_flight, stats)
+        if in_flight:
+          time.sleep(POLL_INTERVAL)
+      paid, outstanding = read_journal(journal_path)
+      stats = { 'paid': 0, 'failed': 0, 'unconfirmed': 0, 'expired': 0 }
+
+    skipped = set().union(*(r for r, _ in outstanding.values()))
+    todo = [r for r in recipients if r not in paid and r not in skipped]
+    print(f'{len(recipients)} recipients, {len(paid)} already paid, '
+      f'{len(skipped)} unconfirmed, {len(todo)} to send')
+    if not todo:
+      return stats
+
+    chunk_size, gas_limit = size_chunks(sdk, session, estimator, drop, todo)
+    def observe(chunk, result):
+      estimator.observe_batch(drop_key(drop), chain_id, len(chunk), result['gas'])
+    chunks = deque(chunked(todo, chunk_size))
+    in_flight = {}
+    while chunks or in_flight:
+      batch = []
+      while chunks and len(in_flight) + len(batch) < window:
+        batch.append(chunks.popleft())
+
+      if batch:
+        signed = [
+          sign_command(sdk, build_airdrop_command(sdk, drop, c, gas_limit(len(c))))
+          for c in batch
+        ]
+        # The request key is the command's hash, so chunks are journaled
+        # before the node can accept them
+        for cmd, chunk in zip(signed, batch):
+          append_journal(journal,
+            { 'event': 'sent', 'requestKey': cmd['hash'], 'recipients': chunk, 'cmd': cmd })
+        send_chunks(sdk, session, chain_id, signed)
+        for cmd, chunk in zip(signed, batch):
+          in_flight[cmd['hash']] = (chunk, time.time(), expires_at(cmd))
+
+      time.sleep(POLL_INTERVAL)
+      confirm(sdk, session, chain_id, journal, in_flight, stats, observe)
+
+      elapsed = time.time() - start
+      print(f'{stats["paid"]}/{len(todo)} paid, {stats["failed"]} failed, '
+        f'{len(in_flight)} chunks in flight, {stats["paid"] / elapsed:.1f} recipients/sec')
+
+  estimator.save(gas_path)
+  return stats
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-f', help='Recipients file, one account per line')
+  parser.add_argument('-t', choices=['coin', 'nft'], default='coin', help='Airdrop type')
+  parser.add_argument('-m', help='Managed account to airdrop from')
+  parser.add_argument('-a', help='Amount per recipient')
+  parser.add_argument('-s', help='Sender, defaults to the k: account of keys.json')
+  parser.add_argument('--token', default=None,
+    help='Fungible module for coin drops (default coin) or ledger for nft drops (default marmalade.ledger)')
+  parser.add_argument('--token-id', help='Token id for nft drops')
+  parser.add_argument('--split', action='store_true',
+    help='Split the amount between all recipients instead, like split-coin')
+  parser.add_argument('--precision', type=int, default=12,
+    help='Precision of the token, used when splitting')
+  parser.add_argument('-j', help='Journal file, defaults to <recipients file>.journal')
+  parser.add_argument('-w', type=int, default=WINDOW, help='Chunks in flight at once')
+  parser.add_argument('-c', default=NETWORK['chain_id'], help='Chain id')
+  args = parser.parse_args()
+
+  key_pair = KeyPair('keys.json')
+  sdk = KadenaSdk(BASE_URL, key_pair)
+  recipients = read_recipients(args.f)
+
+  amount = Decimal(args.a)
+  if args.split:
+    # Every chunk is its own transaction, so split-coin can't be used,
+    # the split is done here and the chunks are airdropped instead
+    amount = (amount / len(recipients)).quantize(
+      Decimal(1).scaleb(-args.precision), rounding=ROUND_DOWN)
+
+  drop = {
+    'type': args.t,
+    'sender': args.s or f'k:{key_pair.get_pub_key()}',
+    'managed_account': args.m,
+    'token': args.token or ('marmalade.ledger' if args.t == 'nft' else 'coin'),
+    'token_id': args.token_id,
+    'amount': amount,
+    'chain_id': args.c,
+  }
+  stats = run_airdrop(sdk, drop, recipients, args.j or f'{args.f}.journal', window=args.w)
+  print(json.dumps(stats))
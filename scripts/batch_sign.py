@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import base64
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from nacl.signing import SigningKey
+
+from fanout import chunked
+
+# Commands per task sent to a worker, big enough that pickling
+# and scheduling cost little next to the signing
+CHUNK_SIZE = 512
+# Below this many commands a pool costs more than it saves
+MIN_POOL_BATCH = 2000
+
+# The expanded signing key of a worker process, built once by init_worker
+_signing_key = None
+
+
+def init_worker(priv_key):
+  global _signing_key
+  _signing_key = SigningKey(bytes.fromhex(priv_key))
+
+
+def hash_and_sign(signing_key, command):
+  """Same as KadenaSdk.hash_and_sign, without going through the base64
+  hash and back before signing. command is a dict or its json."""
+  cmd_json = command if isinstance(command, str) else json.dumps(command)
+  digest = hashlib.blake2b(cmd_json.encode('utf8'), digest_size=32).digest()
+  return {
+    'hash': base64.urlsafe_b64encode(digest).decode().rstrip('='),
+    'sigs': [{'sig': signing_key.sign(digest).signature.hex()}],
+    'cmd': cmd_json,
+  }
+
+
+def sign_chunk(commands):
+  """Worker entry point."""
+  return [hash_and_sign(_signing_key, c) for c in commands]
+
+
+class BatchSigner():
+  """Hashes and signs many commands across a process pool.
+  Each worker expands the private key once and keeps it, and the pool
+  is kept between calls, so only the commands are sent to the workers.
+
+    with BatchSigner(key_pair.get_priv_key()) as signer:
+      signed = signer.sign(commands)
+
+  Returns the commands in the /send format, in the order they were given.
+  """
+
+  def __init__(self, priv_key, workers=None, chunk_size=CHUNK_SIZE):
+    self.priv_key = priv_key
+    self.workers = workers or os.cpu_count()
+    self.chunk_size = chunk_size
+    self.signing_key = SigningKey(bytes.fromhex(priv_key))
+    self.executor = None
+
+
+  def sign(self, commands):
+    if self.workers == 1 or len(commands) < MIN_POOL_BATCH:
+      return [hash_and_sign(self.signing_key, c) for c in commands]
+
+    if self.executor is None:
+      self.executor = ProcessPoolExecutor(
+        max_workers=self.workers,
+        initializer=init_worker,
+        initargs=(self.priv_key,))
+    signed = []
+    for chunk in self.executor.map(sign_chunk, chunked(commands, self.chunk_size)):
+      signed.extend(chunk)
+    return signed
+
+
+  def close(self):
+    if self.executor:
+      self.executor.shutdown()
+      self.executor = None
+
+
+  def __enter__(self):
+    return self
+
+
+  def __exit__(self, *args):
+    self.close()
+
+
+# -------------------------------
+# Benchmark
+
+def bench_commands(n, pub_key):
+  """Commands shaped like a coin transfer, each one different."""
+  return [
+    {
+      "networkId": "testnet04",
+      "payload": {
+        "exec": {
+          "data": {},
+          "code": f'(coin.transfer "k:{pub_key}" "k:receiver-{i}" 1.0)',
+        }
+      },
+      "signers": [
+        {
+          "pubKey": pub_key,
+          "clist": [
+            { "name": "coin.TRANSFER", "args": [f"k:{pub_key}", f"k:receiver-{i}", 1.0] },
+            { "name": "coin.GAS", "args": [] },
+          ]
+        }
+      ],
+      "meta": {
+        "gasLimit": 2500,
+        "chainId": "1",
+        "gasPrice": 1e-5,
+        "sender": f"k:{pub_key}",
+        "ttl": 28000,
+        "creationTime": int(time.time()),
+      },
+      "nonce": str(i),
+    }
+    for i in range(n)
+  ]
+
+
+def benchmark(n, workers_list):
+  sk = SigningKey.generate()
+  priv_key = sk.encode().hex()
+  commands = bench_commands(n, sk.verify_key.encode().hex())
+
+  results = []
+  for workers in workers_list:
+    with BatchSigner(priv_key, workers=workers) as signer:
+      signer.sign(commands[:MIN_POOL_BATCH]) # Start the pool before timing
+      start = time.perf_counter()
+      signer.sign(commands)
+      elapsed = time.perf_counter() - start
+    results.append({
+      'workers': workers,
+      'commands': n,
+      'seconds': elapsed,
+      'sigs_per_sec': n / elapsed,
+      'sigs_per_sec_per_core': n / elapsed / workers,
+    })
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-n', type=int, default=20000, help='Commands to sign')
+  parser.add_argument('-w', type=int, nargs='*', default=None,
+    help='Worker counts to compare, defaults to 1 and every core')
+  args = parser.parse_args()
+
+  workers_list = args.w or sorted({1, os.cpu_count()})
+  print(json.dumps(benchmark(args.n, workers_list), indent=2))
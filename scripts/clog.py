@@ -1,47 +1,314 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+
+from nacl.signing import SigningKey
 from kadena_sdk.kadena_sdk import KadenaSdk
 from kadena_sdk.key_pair import KeyPair
-import time
 
-# Code to run
-PACT_CODE = '"Clog"'
+from airdrop import pact_decimal
+from fanout import create_session, sign_command
+from command_template import CommandTemplate
+from gas_estimator import GasEstimator
+from tracker import RequestTracker, ResultStore
 
-MAINNET = {
-  'base_url': 'https://api.chainweb.com',
-  'network_id': 'mainnet01',
+LOCAL = {
+  'base_url': 'http://localhost:8080',
   'chain_id': '1',
 }
 TESTNET = {
   'base_url': 'https://api.testnet.chainweb.com',
-  'network_id': 'testnet04',
   'chain_id': '1',
 }
-NETWORK = TESTNET
+# Benchmarks run against a local stand-in, never a public network by default
+NETWORK = LOCAL
+# KADENA_NODE_URL points the script at another node, e.g. local_chainweb.py
+BASE_URL = os.environ.get('KADENA_NODE_URL', NETWORK['base_url'])
 
-key_pair = KeyPair('keys.json')
-sdk = KadenaSdk(key_pair, 
-  NETWORK['base_url'], 
-  NETWORK['network_id'], 
-  NETWORK['chain_id'])
+STAKING_CONTRACT = 'free.marmalade-nft-staking'
+MINT_CONTRACT = 'free.nft-mint'
 
-payload = {
-  "exec": {
-    "data": {
-    },
-    "code": PACT_CODE,
-  }
+
+# -------------------------------
+# Payload templates
+# Each takes the sender's public key and the parsed arguments,
+# and returns (payload, clist) for a CommandTemplate.
+# Amounts go in the code as pact decimal literals, str() of a float
+# gives 1e-05, and in caps as { "decimal": ... } so they match exactly.
+
+def cap_decimal(amount):
+  return { "decimal": pact_decimal(amount) }
+
+
+def clog_payload(pub_key, args):
+  return {
+    "exec": {
+      "data": {},
+      "code": '"Clog"',
+    }
+  }, []
+
+
+def transfer_payload(pub_key, args):
+  amount = pact_decimal(args.amount)
+  return {
+    "exec": {
+      "data": {},
+      "code": f'(coin.transfer "k:{pub_key}" "{args.receiver}" {amount})',
+    }
+  }, [
+    { "name": "coin.TRANSFER", "args": [f"k:{pub_key}", args.receiver, cap_decimal(args.amount)] },
+  ]
+
+
+def stake_payload(pub_key, args):
+  amount = pact_decimal(args.amount)
+  return {
+    "exec": {
+      "data": {
+        "staker-guard": { "keys": [pub_key], "pred": "keys-all" }
+      },
+      "code": (f'({STAKING_CONTRACT}.stake "{args.pool}" "k:{pub_key}" '
+        f'{amount} (read-keyset "staker-guard"))'),
+    }
+  }, [
+    { "name": f"{STAKING_CONTRACT}.STAKE", "args": [args.pool, f"k:{pub_key}", cap_decimal(args.amount)] },
+    { "name": "marmalade.ledger.TRANSFER", 
+      "args": [args.token_id, f"k:{pub_key}", args.escrow, cap_decimal(args.amount)] },
+  ]
+
+
+def mint_payload(pub_key, args):
+  return {
+    "exec": {
+      "data": {},
+      "code": f'({MINT_CONTRACT}.mint "{args.collection}" "k:{pub_key}" 1)',
+    }
+  }, [
+    { "name": "coin.TRANSFER", "args": [f"k:{pub_key}", args.bank, cap_decimal(args.amount)] },
+  ]
+
+
+PAYLOADS = {
+  'clog': clog_payload,
+  'transfer': transfer_payload,
+  'stake': stake_payload,
+  'mint': mint_payload,
 }
-signers = [
-  {
-    "pubKey": key_pair.get_pub_key()
+
+
+def measure_gas_limit(sdk, chain_id, payload, signers, sender, session):
+  """The payload's gas limit, from a /local preflight at the max gas."""
+  estimator = GasEstimator()
+  template = CommandTemplate(sdk.network_id, chain_id, payload, signers,
+    sender=sender, gas_limit=estimator.max_gas)
+
+  def local(cmd):
+    resp = session.post(sdk.build_url(sdk.LOCAL, chain_id), json=sign_command(sdk, cmd))
+    resp.raise_for_status()
+    return resp.json()
+  return estimator.estimate(json.loads(template.render()), local)
+
+
+def build_template(sdk, args, session):
+  """Every transaction of a run only differs by its nonce.
+  The gas limit is measured unless one is given with -g."""
+  pub_key = sdk.key_pair.get_pub_key()
+  payload, clist = PAYLOADS[args.t](pub_key, args)
+  signers = [
+    {
+      "pubKey": pub_key,
+      "clist": clist + [{ "name": "coin.GAS", "args": [] }],
+    }
+  ]
+  sender = f'k:{pub_key}'
+  if args.g is None:
+    args.g = measure_gas_limit(sdk, args.c, payload, signers, sender, session)
+  return CommandTemplate(sdk.network_id, args.c, payload, signers,
+    sender=sender, gas_limit=args.g)
+
+
+# -------------------------------
+# Stats
+
+def percentile(values, p):
+  """Nearest rank percentile, None when there are no values."""
+  if not values:
+    return None
+  values = sorted(values)
+  rank = max(int(round(p / 100 * len(values) + 0.5)) - 1, 0)
+  return values[min(rank, len(values) - 1)]
+
+
+def summarize(values):
+  return {
+    'count': len(values),
+    'mean': sum(values) / len(values) if values else None,
+    'p50': percentile(values, 50),
+    'p95': percentile(values, 95),
+    'p99': percentile(values, 99),
+    'max': max(values) if values else None,
   }
-]
 
-def job():
-  cmd = sdk.build_command(f'k:{key_pair.get_pub_key()}', 
-    payload, signers, gas_limit=150000, gas_price=1e-4)
-  result = sdk.send(cmd)
-  print(result.text)
 
-while True:
-  job()
-  time.sleep(20)
\ No newline at end of file
+# -------------------------------
+# Load generator
+
+async def run_benchmark(sdk, args):
+  """Starts transactions at the target rate for the duration,
+  with at most args.n submits in flight, then waits for confirmations."""
+  loop = asyncio.get_running_loop()
+  loop.set_default_executor(ThreadPoolExecutor(max_workers=args.n))
+  session = create_session(args.n)
+  tracker = RequestTracker(sdk, store=ResultStore(':memory:'), session=session,
+    min_interval=0.5, max_interval=5, timeout=args.confirm_timeout)
+  endpoint = sdk.build_url(sdk.LOCAL if args.local else sdk.SEND, args.c)
+  semaphore = asyncio.Semaphore(args.n)
+  template = build_template(sdk, args, session)
+  signing_key = SigningKey(bytes.fromhex(sdk.key_pair.get_priv_key()))
+
+  submit_latencies = []
+  confirm_latencies = []
+  errors = { 'submit': 0, 'failure': 0, 'timeout': 0 }
+  error_samples = []
+  confirmations = []
+
+  def on_confirmed(sent_at):
+    def callback(result):
+      if result['status'] == 'success':
+        confirm_latencies.append(time.perf_counter() - sent_at)
+      else:
+        errors['failure' if result['status'] == 'failure' else 'timeout'] += 1
+    return callback
+
+  def post(signed):
+    if args.local:
+      return session.post(endpoint, json=signed)
+    return session.post(endpoint, json={'cmds': [signed]})
+
+  async def submit(i):
+    async with semaphore:
+      signed = template.render_signed(signing_key)
+      sent_at = time.perf_counter()
+      try:
+        resp = await loop.run_in_executor(None, post, signed)
+        ok = resp.status_code == 200
+        if not ok and len(error_samples) < 5:
+          error_samples.append(resp.text[:200])
+      except Exception as e:
+        ok = False
+        if len(error_samples) < 5:
+          error_samples.append(str(e))
+      submit_latencies.append(time.perf_counter() - sent_at)
+
+      if not ok:
+        errors['submit'] += 1
+      elif args.local:
+        if resp.json()['result']['status'] != 'success':
+          errors['failure'] += 1
+      else:
+        confirmations.append(
+          tracker.track(signed['hash'], args.c, on_confirmed(sent_at)))
+
+  submitting = True
+
+  async def confirm_loop():
+    # Confirms while still sending, so the latency isn't inflated by the run
+    while submitting or any(tracker.pending.values()):
+      await tracker.run()
+      await asyncio.sleep(0.1)
+
+  start = time.perf_counter()
+  confirmer = asyncio.create_task(confirm_loop())
+  tasks = []
+  i = 0
+  # Open loop: transactions start on schedule, whether or not the last finished
+  while time.perf_counter() - start < args.d:
+    tasks.append(asyncio.create_task(submit(i)))
+    i += 1
+    next_at = start + i / args.tps
+    await asyncio.sleep(max(next_at - time.perf_counter(), 0))
+  await asyncio.gather(*tasks)
+  submit_elapsed = time.perf_counter() - start
+
+  submitting = False
+  await confirmer
+  await asyncio.gather(*confirmations)
+  elapsed = time.perf_counter() - start
+
+  sent = len(tasks)
+  return {
+    'config': {
+      'base_url': sdk.base_url,
+      'chain_id': args.c,
+      'payload': args.t,
+      'target_tps': args.tps,
+      'concurrency': args.n,
+      'duration': args.d,
+      'local': args.local,
+      'gas_limit': args.g,
+    },
+    'sent': sent,
+    'achieved_tps': sent / submit_elapsed,
+    'confirmed_tps': len(confirm_latencies) / elapsed if not args.local else None,
+    'submit_latency': summarize(submit_latencies),
+    'confirm_latency': summarize(confirm_latencies),
+    'errors': errors,
+    'error_rate': {
+      name: count / sent if sent else 0.0 for name, count in errors.items()
+    },
+    'error_samples': error_samples,
+    'polls': tracker.polls,
+    'elapsed': elapsed,
+  }
+
+
+def load_key_pair(path):
+  """Uses keys.json when it is there, otherwise a throwaway key,
+  which is all a local stand-in needs."""
+  try:
+    return KeyPair(path)
+  except FileNotFoundError:
+    sk = SigningKey.generate()
+    return KeyPair(type='json',
+      priv_key=sk.encode().hex(),
+      pub_key=sk.verify_key.encode().hex())
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-u', default=BASE_URL, help='Base url of the Pact API')
+  parser.add_argument('-c', default=NETWORK['chain_id'], help='Chain id')
+  parser.add_argument('-t', choices=PAYLOADS.keys(), default='clog', help='Payload template')
+  parser.add_argument('--tps', type=float, default=10.0, help='Target transactions per second')
+  parser.add_argument('-n', type=int, default=16, help='Max submits in flight')
+  parser.add_argument('-d', type=float, default=30.0, help='Duration in seconds')
+  parser.add_argument('-g', type=int, default=None,
+    help='Gas limit, measured with /local by default')
+  parser.add_argument('-o', help='Write the json report to this file')
+  parser.add_argument('-k', default='keys.json', help='Key file')
+  parser.add_argument('--local', action='store_true',
+    help='Benchmark /local instead of /send, nothing to confirm')
+  parser.add_argument('--confirm-timeout', type=float, default=120.0)
+  # Template arguments
+  parser.add_argument('--amount', type=Decimal, default=Decimal('0.0001'))
+  parser.add_argument('--receiver', default='clog-receiver')
+  parser.add_argument('--pool', default='pool-test')
+  parser.add_argument('--token-id', default='stakable-nft')
+  parser.add_argument('--escrow', default='m:free.marmalade-nft-staking:pool-test')
+  parser.add_argument('--collection', default='test-collection')
+  parser.add_argument('--bank', default='test-bank')
+  args = parser.parse_args()
+
+  sdk = KadenaSdk(args.u, load_key_pair(args.k))
+  report = asyncio.run(run_benchmark(sdk, args))
+
+  text = json.dumps(report, indent=2)
+  if args.o:
+    with open(args.o, 'w') as f:
+      f.write(text)
+  print(text)
@@ -0,0 +1,338 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from kadena_sdk.kadena_sdk import KadenaSdk
+from kadena_sdk.key_pair import KeyPair
+
+from fanout import create_session, sign_command
+from gas_estimator import GasEstimator
+
+MAINNET = {
+  'base_url': 'https://api.chainweb.com',
+  'chain_ids': ['1'],
+}
+TESTNET = {
+  'base_url': 'https://api.testnet.chainweb.com',
+  'chain_ids': ['1'],
+}
+NETWORK = TESTNET
+# KADENA_NODE_URL points the script at another node, e.g. local_chainweb.py
+BASE_URL = os.environ.get('KADENA_NODE_URL', NETWORK['base_url'])
+
+POLL = '/poll'
+POLL_INTERVAL = 5
+# Seconds to wait for a deploy to be mined
+CONFIRM_TIMEOUT = 600
+# Deploys in flight at once, across modules and chains
+WORKERS = 8
+
+_NAMESPACE = re.compile(r'^\s*\(namespace\s+[\'"]?([\w-]+)', re.M)
+_DEFINITION = re.compile(r'^\s*\((module|interface)\s+([\w-]+)', re.M)
+# ns.module.member, or module.member for modules outside a namespace
+_QUALIFIED = re.compile(r'(?<![\w.-])((?:[\w-]+\.)?[\w-]+)\.[\w-]+')
+_USE = re.compile(r'\((?:use|implements)\s+([\w.-]+)')
+_COMMENT = re.compile(r';[^\n]*')
+_TABLE = re.compile(r'\(deftable\s+([\w-]+)')
+# The top level (if (read-msg "flag") ...) that creates the tables
+_DEPLOY_FLAG = re.compile(r'\(if\s+\(read-msg\s+["\']([\w-]+)["\']\s*\)')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.S)
+
+
+def module_form(code, start):
+  """The text of the form that opens at start, e.g. the whole (module ...)
+  or a [...] list."""
+  depth = 0
+  i = start
+  while i < len(code):
+    c = code[i]
+    if c == '"':
+      i = _STRING.match(code, i).end()
+      continue
+    if c == ';':
+      i = code.find('\n', i)
+      if i == -1:
+        break
+      continue
+    if c in '([':
+      depth += 1
+    elif c in ')]':
+      depth -= 1
+      if depth == 0:
+        return code[start:i + 1]
+    i += 1
+  raise ValueError('Unbalanced parens in module')
+
+
+def deploy_flag(code, table):
+  """The env data flag the top level code reads to decide whether to
+  create the tables, and the value of it that means a first deploy.
+  Modules don't agree on what the flag means (nft-mint's upgrade is true
+  on upgrades, token-presale's is true on first deploys, staking reads
+  init), so it's the branch that creates table that counts.
+  None if the code doesn't read a flag."""
+  code = _COMMENT.sub('', code)
+  match = _DEPLOY_FLAG.search(code)
+  if match is None or table is None:
+    return None
+  rest = code[match.end():].lstrip()
+  then_branch = module_form(rest, 0) if rest[:1] in '([' else rest.split(None, 1)[0]
+  creates = re.compile(r'\(create-table\s+(?:[\w-]+\.)*' + re.escape(table) + r'\s*\)')
+  return match.group(1), bool(creates.search(then_branch))
+
+
+def content_hash(code):
+  """Hash of the code with comments and whitespace normalized, so
+  reformatting doesn't count as a change."""
+  code = _COMMENT.sub('', code)
+  code = ' '.join(code.split())
+  return hashlib.blake2b(code.encode('utf8'), digest_size=32).hexdigest()
+
+
+class Module():
+  """A module or interface parsed from a .pact file."""
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'r') as f:
+      self.code = f.read()
+
+    namespace = _NAMESPACE.search(self.code)
+    definition = _DEFINITION.search(self.code)
+    if definition is None:
+      raise ValueError(f'No module or interface in {path}')
+    self.namespace = namespace.group(1) if namespace else None
+    self.kind = definition.group(1)
+    self.name = definition.group(2)
+    self.form = module_form(self.code, definition.start(1) - 1)
+    self.hash = content_hash(self.form)
+    table = _TABLE.search(self.form)
+    # The code after the module decides whether to create the tables
+    self.deploy_flag = deploy_flag(
+      self.code[definition.start(1) - 1 + len(self.form):],
+      table.group(1) if table else None)
+
+    # Strings and comments can't reference modules
+    body = _STRING.sub('""', _COMMENT.sub('', self.form))
+    self.references = set(_USE.findall(body)) | set(_QUALIFIED.findall(body))
+
+
+  @property
+  def qualified_name(self):
+    return f'{self.namespace}.{self.name}' if self.namespace else self.name
+
+
+  def dependencies(self, modules):
+    """The modules in modules this one references."""
+    deps = set()
+    for ref in self.references:
+      # Unqualified references resolve to the same namespace
+      for name in [ref, f'{self.namespace}.{ref}']:
+        if name in modules and name != self.qualified_name:
+          deps.add(name)
+    return deps
+
+
+def build_graph(paths):
+  """Parses the files and returns ({ name: Module }, { name: deps }).
+  Only references between the given modules are edges, anything else
+  (coin, marmalade, kip) is expected to be on chain already."""
+  modules = {}
+  for path in paths:
+    module = Module(path)
+    if module.qualified_name in modules:
+      raise ValueError(f'{module.qualified_name} is defined in '
+        f'{modules[module.qualified_name].path} and {path}')
+    modules[module.qualified_name] = module
+
+  graph = { name: m.dependencies(modules) for name, m in modules.items() }
+  topological_order(graph)
+  return modules, graph
+
+
+def topological_order(graph):
+  """Orders the modules so dependencies come first. Raises on cycles."""
+  order = []
+  state = {} # name -> 'visiting' or 'done'
+  def visit(name, path):
+    if state.get(name) == 'done':
+      return
+    if state.get(name) == 'visiting':
+      raise ValueError(f'Dependency cycle: {" -> ".join(path + [name])}')
+    state[name] = 'visiting'
+    for dep in sorted(graph[name]):
+      visit(dep, path + [name])
+    state[name] = 'done'
+    order.append(name)
+  for name in sorted(graph):
+    visit(name, [])
+  return order
+
+
+# -------------------------------
+# Chain
+
+class Deployer():
+  """Deploys a set of modules to several chains.
+
+  A module is deployed to a chain once all of its dependencies are done
+  on that chain, so independent modules and chains go out in parallel.
+  Modules whose content hash matches the code on chain are skipped.
+  """
+
+  def __init__(self, sdk, modules, graph, data=None, workers=WORKERS,
+    cascade=False, dry_run=False, session=None, estimator=None):
+    self.sdk = sdk
+    self.modules = modules
+    self.graph = graph
+    self.data = data or {}
+    self.workers = workers
+    self.cascade = cascade
+    self.dry_run = dry_run
+    self.session = session or create_session(workers)
+    self.estimator = estimator or GasEstimator()
+
+
+  def _local(self, cmd):
+    signed = sign_command(self.sdk, cmd)
+    resp = self.session.post(self.sdk.build_url(self.sdk.LOCAL, cmd['meta']['chainId']), json=signed)
+    resp.raise_for_status()
+    return resp.json()
+
+
+  def deployed_hash(self, name, chain_id):
+    """Content hash of the module on chain, None if it isn't deployed."""
+    payload = self.sdk.build_exec_payload(f'(describe-module "{name}")')
+    cmd = self.sdk.build_command(payload, [chain_id])[chain_id]
+    result = self._local(cmd)['result']
+    if result['status'] != 'success' or not isinstance(result['data'], dict):
+      return None
+    return content_hash(result['data']['code'])
+
+
+  def _confirm(self, chain_id, request_key):
+    url = self.sdk.build_url(POLL, chain_id)
+    start = time.time()
+    while time.time() - start < CONFIRM_TIMEOUT:
+      time.sleep(POLL_INTERVAL)
+      resp = self.session.post(url, json={ 'requestKeys': [request_key] })
+      resp.raise_for_status()
+      result = resp.json().get(request_key)
+      if result:
+        return result
+    raise Exception(f'{request_key} not mined after {CONFIRM_TIMEOUT}s')
+
+
+  def deploy(self, name, chain_id, force=False):
+    """Deploys one module to one chain. Returns 'skipped' or 'deployed'."""
+    module = self.modules[name]
+    on_chain = self.deployed_hash(name, chain_id)
+    if on_chain == module.hash and not force:
+      return 'skipped'
+    if self.dry_run:
+      return 'would deploy'
+
+    data = dict(self.data)
+    if module.deploy_flag is not None:
+      flag, first_deploy = module.deploy_flag
+      data[flag] = first_deploy if on_chain is None else not first_deploy
+    payload = self.sdk.build_exec_payload(module.code, data)
+    cmd = self.sdk.build_command(payload, [chain_id])[chain_id]
+    gas = self.estimator.preflight(cmd, self._local)
+    cmd['meta']['gasLimit'] = self.estimator.limit(gas)
+
+    signed = sign_command(self.sdk, cmd)
+    resp = self.session.post(self.sdk.build_url(self.sdk.SEND, chain_id), json={ 'cmds': [signed] })
+    resp.raise_for_status()
+    result = self._confirm(chain_id, signed['hash'])
+    if result['result']['status'] != 'success':
+      raise Exception(f'Deploy failed: {result["result"]["error"]}')
+    return 'deployed'
+
+
+  def run(self, chain_ids):
+    """Deploys every module to every chain. Returns { (name, chain_id): status }.
+    A failed module fails its dependents on the same chain, other
+    modules and chains carry on."""
+    order = topological_order(self.graph)
+    results = {}
+    changed = { chain_id: set() for chain_id in chain_ids }
+    running = {}
+
+    def ready():
+      for chain_id in chain_ids:
+        for name in order:
+          if (name, chain_id) in results or (name, chain_id) in running.values():
+            continue
+          deps = [(dep, chain_id) for dep in self.graph[name]]
+          if all(dep in results for dep in deps):
+            yield name, chain_id, [results[dep] for dep in deps]
+
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      while len(results) < len(order) * len(chain_ids):
+        for name, chain_id, dep_results in list(ready()):
+          if any(r.startswith('failed') for r in dep_results):
+            results[(name, chain_id)] = 'failed: dependency failed'
+            print(f'{name} on chain {chain_id}: {results[(name, chain_id)]}')
+            continue
+          # Dependents inline their dependencies, so they only pick up
+          # a change once they are deployed again
+          force = self.cascade and bool(self.graph[name] & changed[chain_id])
+          future = executor.submit(self.deploy, name, chain_id, force)
+          running[future] = (name, chain_id)
+
+        if not running:
+          continue
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+          name, chain_id = running.pop(future)
+          try:
+            results[(name, chain_id)] = future.result()
+          except Exception as e:
+            results[(name, chain_id)] = f'failed: {e}'
+          if results[(name, chain_id)] in ['deployed', 'would deploy']:
+            changed[chain_id].add(name)
+          print(f'{name} on chain {chain_id}: {results[(name, chain_id)]}')
+    return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-p', nargs='+', required=True, help='Contract files, in any order')
+  parser.add_argument('-d', help='Env data json file, e.g. nft-init-data.json')
+  parser.add_argument('-c', nargs='*', default=NETWORK['chain_ids'], help='Chain ids')
+  parser.add_argument('-w', type=int, default=WORKERS, help='Deploys in flight at once')
+  parser.add_argument('--cascade', action='store_true',
+    help='Also redeploy the dependents of changed modules')
+  parser.add_argument('--dry-run', action='store_true',
+    help='Only print what would be deployed')
+  args = parser.parse_args()
+
+  modules, graph = build_graph(args.p)
+  print('Deploy order:')
+  for name in topological_order(graph):
+    deps = ', '.join(sorted(graph[name])) or 'none'
+    print(f'  {name} ({modules[name].path}), depends on {deps}')
+
+  data = {}
+  if args.d:
+    with open(args.d, 'r') as f:
+      data = json.load(f)
+
+  key_pair = KeyPair('keys.json')
+  sdk = KadenaSdk(BASE_URL, key_pair)
+  start = time.perf_counter()
+  results = Deployer(sdk, modules, graph, data, workers=args.w,
+    cascade=args.cascade, dry_run=args.dry_run).run(args.c)
+
+  counts = {}
+  for status in results.values():
+    counts[status.split(':')[0]] = counts.get(status.split(':')[0], 0) + 1
+  print(f'{counts} in {time.perf_counter() - start:.1f}s')
+  if 'failed' in counts:
+    sys.exit(1)
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import argparse
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from kadena_sdk.kadena_sdk import KadenaSdk
+from kadena_sdk.key_pair import KeyPair
+
+MAINNET = {
+  'base_url': 'https://api.chainweb.com',
+  'chain_ids': [str(i) for i in range(20)],
+}
+TESTNET = {
+  'base_url': 'https://api.testnet.chainweb.com',
+  'chain_ids': [str(i) for i in range(20)],
+}
+NETWORK = TESTNET
+# KADENA_NODE_URL points the script at another node, e.g. local_chainweb.py
+BASE_URL = os.environ.get('KADENA_NODE_URL', NETWORK['base_url'])
+
+MAX_CHAINS = 20
+
+
+def create_session(pool_size=MAX_CHAINS):
+  """A keep-alive session with a connection per chain, so fanning out
+  again reuses the connections instead of doing new TLS handshakes."""
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(
+    pool_connections=pool_size,
+    pool_maxsize=pool_size)
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
+
+
+def sign_command(sdk, command):
+  """Hashes and signs a command, returning it in the /send format."""
+  cmd_json = json.dumps(command)
+  hash_code, sig = sdk.hash_and_sign(cmd_json)
+  return {
+    'hash': hash_code,
+    'sigs': [] if sig is None else [{'sig': sig}],
+    'cmd': cmd_json,
+  }
+
+
+def chunked(items, size):
+  """Splits items into lists of at most size, e.g. the commands of one /send."""
+  it = iter(items)
+  while True:
+    chunk = list(islice(it, size))
+    if not chunk:
+      return
+    yield chunk
+
+
+def post_command(sdk, session, chain_id, signed, send):
+  """Posts a signed command to one chain and times it.
+  Errors are returned instead of raised so one chain can't stop the others."""
+  start = time.perf_counter()
+  result = { 'chain_id': chain_id, 'request_key': signed['hash'] }
+  try:
+    if send:
+      resp = session.post(sdk.build_url(sdk.SEND, chain_id), json={'cmds': [signed]})
+    else:
+      resp = session.post(sdk.build_url(sdk.LOCAL, chain_id), json=signed)
+    result['status_code'] = resp.status_code
+    if resp.status_code == 200:
+      result['response'] = resp.json()
+    else:
+      result['error'] = resp.text
+  except requests.RequestException as e:
+    result['error'] = str(e)
+  result['latency'] = time.perf_counter() - start
+  return result
+
+
+def fan_out(sdk, payload, chain_ids, signers=None, send=False, session=None, **kwargs):
+  """Builds, signs and posts the same command to every chain at once.
+  Sends with /send when send is True, otherwise runs it with /local.
+  Yields each chain's result as it arrives:
+  { chain_id, request_key, status_code, response or error, latency }.
+  Extra arguments (sender, gas_limit, gas_price) go to build_command."""
+  session = session or create_session(len(chain_ids))
+  cmds = sdk.build_command(payload, chain_ids, signers, **kwargs)
+  signed = { chain_id: sign_command(sdk, cmd) for chain_id, cmd in cmds.items() }
+
+  with ThreadPoolExecutor(max_workers=min(len(chain_ids), MAX_CHAINS)) as executor:
+    futures = [
+      executor.submit(post_command, sdk, session, chain_id, cmd, send)
+      for chain_id, cmd in signed.items()
+    ]
+    for future in as_completed(futures):
+      yield future.result()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-p', help='Pact code to run')
+  parser.add_argument('-d', default='{}', help='Env data as json')
+  parser.add_argument('-c', nargs='*', default=NETWORK['chain_ids'], help='Chain ids')
+  parser.add_argument('-g', type=int, default=2500, help='Gas limit')
+  parser.add_argument('--send', action='store_true', help='Send instead of local')
+  args = parser.parse_args()
+
+  key_pair = KeyPair('keys.json') if args.send else None
+  sdk = KadenaSdk(BASE_URL, key_pair)
+  payload = sdk.build_exec_payload(args.p, json.loads(args.d))
+
+  start = time.perf_counter()
+  for result in fan_out(sdk, payload, args.c, send=args.send, gas_limit=args.g):
+    print(f'chain {result["chain_id"]} ({result["latency"]:.3f}s): '
+      f'{json.dumps(result.get("response", result.get("error")))}')
+  print(f'{len(args.c)} chains in {time.perf_counter() - start:.3f}s')
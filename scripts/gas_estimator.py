@@ -0,0 +1,164 @@
+"""Gas limits measured with /local instead of picked by hand.
+
+Estimates are cached per (code template, chain) and kept as an EWMA, so
+a template is only preflighted again once its estimate is older than
+max_age. Gas seen in real results can be fed back with observe.
+
+Batches (many tokens or recipients in one transaction) are modeled as a
+fixed base plus a cost per item, measured with two probe sizes.
+
+The reveal lambda imports it too, prep-nft-reveal.sh and app.py copy it
+into the lambda bundle.
+"""
+import re
+import json
+import math
+import time
+
+# Highest gas limit chainweb accepts for a transaction
+MAX_GAS = 150000
+# Limits are set this much above the measured gas
+GAS_MARGIN = 1.2
+# Weight of a new measurement in the average
+EWMA_ALPHA = 0.3
+# Seconds before an estimate is preflighted again
+MAX_AGE = 600
+# Batch sizes used to measure the base and per item gas
+PROBE_SIZES = (1, 10)
+
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_SPACE = re.compile(r'\s+')
+
+
+def template_key(code):
+  """The code with its literals taken out, so commands that only differ
+  by their arguments share an estimate."""
+  code = _STRING.sub('""', code)
+  code = _NUMBER.sub('0', code)
+  return _SPACE.sub(' ', code).strip()
+
+
+def ewma(old, new, alpha):
+  return new if old is None else alpha * new + (1 - alpha) * old
+
+
+class GasEstimator():
+  """local is a function that runs a command dict with /local and
+  returns the response json, e.g.
+    lambda cmd: kadena.local({ cmd['meta']['chainId']: cmd })[cmd['meta']['chainId']].json()
+  """
+
+  def __init__(self, margin=GAS_MARGIN, alpha=EWMA_ALPHA, max_age=MAX_AGE, max_gas=MAX_GAS):
+    self.margin = margin
+    self.alpha = alpha
+    self.max_age = max_age
+    self.max_gas = max_gas
+    self.estimates = {} # (key, chain_id) -> { gas, updated }
+    self.batches = {} # (key, chain_id) -> { base, per_item, updated }
+
+
+  def _fresh(self, entry):
+    return entry is not None and time.time() - entry['updated'] < self.max_age
+
+
+  def limit(self, gas):
+    """The gas limit to use for a measured gas."""
+    return min(math.ceil(gas * self.margin), self.max_gas)
+
+
+  def preflight(self, cmd, local):
+    """Runs the command with the highest limit and returns the gas it used."""
+    cmd = { **cmd, 'meta': { **cmd['meta'], 'gasLimit': self.max_gas } }
+    resp = local(cmd)
+    if resp['result']['status'] != 'success':
+      raise Exception(f'Preflight failed: {resp["result"]["error"]}')
+    return resp['gas']
+
+
+  def observe(self, key, chain_id, gas):
+    """Folds a measured gas into the template's estimate."""
+    entry = self.estimates.get((key, chain_id))
+    self.estimates[(key, chain_id)] = {
+      'gas': ewma(entry and entry['gas'], gas, self.alpha),
+      'updated': time.time(),
+    }
+
+
+  def estimate(self, cmd, local, key=None):
+    """Returns a gas limit for the command, preflighting it only when
+    its template has no fresh estimate."""
+    key = key or template_key(cmd['payload']['exec']['code'])
+    chain_id = cmd['meta']['chainId']
+    if not self._fresh(self.estimates.get((key, chain_id))):
+      self.observe(key, chain_id, self.preflight(cmd, local))
+    return self.limit(self.estimates[(key, chain_id)]['gas'])
+
+
+  # -------------------------------
+  # Batches
+
+  def measure_batch(self, key, chain_id, build, count, local, sizes=PROBE_SIZES):
+    """Returns the (base, per_item) gas of a batch template.
+    build(n) returns a command for the first n items, count is how many
+    items there are. Probes are only run when the estimate isn't fresh."""
+    entry = self.batches.get((key, chain_id))
+    if self._fresh(entry):
+      return entry['base'], entry['per_item']
+
+    small, large = (min(size, count) for size in sizes)
+    gas_small = self.preflight(build(small), local)
+    if large == small:
+      base, per_item = 0, gas_small / small
+    else:
+      gas_large = self.preflight(build(large), local)
+      per_item = (gas_large - gas_small) / (large - small)
+      base = max(gas_small - per_item * small, 0)
+
+    self.batches[(key, chain_id)] = {
+      'base': ewma(entry and entry['base'], base, self.alpha),
+      'per_item': ewma(entry and entry['per_item'], per_item, self.alpha),
+      'updated': time.time(),
+    }
+    entry = self.batches[(key, chain_id)]
+    return entry['base'], entry['per_item']
+
+
+  def observe_batch(self, key, chain_id, count, gas):
+    """Folds the gas of a mined batch into the per item estimate."""
+    entry = self.batches.get((key, chain_id))
+    if entry is None or count == 0:
+      return
+    per_item = (gas - entry['base']) / count
+    if per_item > 0:
+      entry['per_item'] = ewma(entry['per_item'], per_item, self.alpha)
+      entry['updated'] = time.time()
+
+
+  def batch_size(self, base, per_item):
+    """How many items fit under the max gas, with the margin."""
+    return max(int((self.max_gas / self.margin - base) / per_item), 1)
+
+
+  def batch_limit(self, base, per_item, count):
+    return self.limit(base + per_item * count)
+
+
+  # -------------------------------
+  # Persistence
+
+  def save(self, path):
+    def dump(cache):
+      return [{ 'key': k, 'chain_id': c, **v } for (k, c), v in cache.items()]
+    with open(path, 'w') as f:
+      json.dump({ 'estimates': dump(self.estimates), 'batches': dump(self.batches) }, f, indent=2)
+
+
+  def load(self, path):
+    with open(path, 'r') as f:
+      saved = json.load(f)
+    for name in ['estimates', 'batches']:
+      cache = getattr(self, name)
+      for entry in saved[name]:
+        key, chain_id = entry.pop('key'), entry.pop('chain_id')
+        cache[(key, chain_id)] = entry
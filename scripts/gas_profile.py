@@ -0,0 +1,410 @@
+import os
+import re
+import sys
+import json
+import math
+import shutil
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+BASELINE = os.path.join(ROOT, 'scripts', 'gas-baseline.json')
+# Highest gas limit chainweb accepts for a transaction
+MAX_GAS = 150000
+# Gas limit while profiling, high enough that nothing is cut off
+PROFILE_GAS_LIMIT = 100000000
+SIZES = [1, 10, 25, 50, 100]
+# How much worse than the baseline a fit can get before it fails
+TOLERANCE = 0.1
+EXPONENT_TOLERANCE = 0.15
+# Seconds before a scenario is killed
+TIMEOUT = 1800
+
+MARKER = '@@'
+
+
+def pact_list(values):
+  return '[' + ' '.join(json.dumps(v) for v in values) + ']'
+
+
+def accounts(prefix, n):
+  return [f'{prefix}-{i}' for i in range(1, n + 1)]
+
+
+# -------------------------------
+# Scenarios
+# Each one loads an existing suite's environment from dir, then for
+# every size runs setup(n) and measures the gas of measure(n).
+
+def mint_setup(n):
+  return f'''
+(env-keys ["ops"])
+(env-data {{ "ks": {{ "keys": ["gov"], "pred": "keys-all" }} }})
+(free.nft-mint.create-collection
+  {{ "name": "gas-{n}"
+  , "total-supply": {n}.0
+  , "provenance": ""
+  , "root-uri": ""
+  , "tiers": [
+      {{ "tier-id": "public"
+      , "tier-type": "PUBLIC"
+      , "start-time": (time "2000-01-01T00:00:00Z")
+      , "end-time": (time "2000-01-01T00:00:00Z")
+      , "cost": 0.0
+      , "limit": -1.0
+      }}
+    ]
+  }}
+  coin
+  (read-keyset "ks"))
+(env-chain-data {{ "block-time": (time "2000-01-02T00:00:00Z") }})
+'''
+
+
+def mint_measure(n):
+  return f'(free.nft-mint.mint "gas-{n}" "bob" {n})'
+
+
+def whitelist_setup(n):
+  return '(env-keys ["ops"])'
+
+
+def whitelist_measure(n):
+  return (f'(free.nft-mint.add-whitelist-to-collection "test-collection" '
+    f'[{{ "tier-id": "free", "accounts": {pact_list(accounts(f"wl-{n}", n))} }}])')
+
+
+def approve_all_setup(n):
+  return f'''
+(env-keys ["ops"])
+(env-sigs [{{ "key": "ops", "caps": [(free.token-sale-manager.OPS)] }}])
+(free.token-sale-manager.create-sale "gas-{n}" "off-chain"
+  (time "2000-01-02T00:00:00Z") (time "2000-01-10T00:00:00Z")
+  100.0 {n * 100}.0 {n * 100}.0 false)
+(map
+  (lambda (i)
+    (free.token-sale-manager.reserve-off-chain "gas-{n}" (format "tx-{{}}" [i])
+      "person1" "kda" 1.0 100.0 (time "2000-01-05T00:00:00Z")))
+  (enumerate 1 {n}))
+'''
+
+
+def approve_all_measure(n):
+  return '(free.token-sale-manager.approve-all)'
+
+
+def airdrop_setup(n):
+  recipients = accounts(f'drop-{n}', n)
+  return f'''
+(use repl-coin-tools)
+(fund-accounts {pact_list(recipients)} 1.0)
+(env-keys ["alice-key"])
+(env-sigs [{{
+  "key": "alice-key",
+  "caps": [
+    (free.airdrop.MANAGED "gas-drop")
+    (coin.TRANSFER "alice" "gas-drop" {n * 0.01:.2f})
+  ]
+}}])
+'''
+
+
+def airdrop_measure(n):
+  return f'(free.airdrop.airdrop-coin "alice" "gas-drop" coin 0.01 {pact_list(accounts(f"drop-{n}", n))})'
+
+
+def pool_bonus_setup(n):
+  stakers = accounts(f'staker-{n}', n)
+  escrow = f'(free.marmalade-nft-staking.get-pool-escrow "gas-{n}")'
+  mint_caps = ' '.join(f'(marmalade.ledger.MINT "token" "{s}" 1.0)' for s in stakers)
+  stake_caps = ' '.join(
+    f'(marmalade.ledger.TRANSFER "token" "{s}" {escrow} 1.0) '
+    f'(free.marmalade-nft-staking.STAKE "gas-{n}" "{s}" 1.0)'
+    for s in stakers)
+  return f'''
+(env-keys ["ops" "mint" "staker"])
+(env-data {{ "ks": {{ "keys": ["staker"], "pred": "keys-all" }} }})
+(env-chain-data {{ "block-time": (time "1970-01-01T00:00:00Z") }})
+(env-sigs [{{ "key": "ops", "caps": [(free.marmalade-nft-staking.OPS)] }}])
+(free.marmalade-nft-staking.create-locked-nft-pool "gas-{n}" "token" coin 0.1 1000.0
+  (time "2000-01-01T00:00:00Z") free.marmalade-nft-staking.SECONDS_IN_YEAR 50.0)
+(env-sigs [
+  {{ "key": "ops", "caps": [(free.marmalade-nft-staking.OPS)] }},
+  {{ "key": "mint", "caps": [{mint_caps}] }},
+  {{ "key": "staker", "caps": [{stake_caps}] }}
+])
+(map
+  (lambda (account)
+    (marmalade.ledger.create-account "token" account (read-keyset "ks"))
+    (install-capability (marmalade.ledger.MINT "token" account 1.0))
+    (marmalade.ledger.mint "token" account (read-keyset "ks") 1.0)
+    (free.marmalade-nft-staking.stake "gas-{n}" account 1.0 (read-keyset "ks")))
+  {pact_list(stakers)})
+'''
+
+
+def pool_bonus_measure(n):
+  return f'(free.marmalade-nft-staking.set-pool-bonus "gas-{n}" 100.0)'
+
+
+SCENARIOS = {
+  'nft-mint.mint': {
+    'dir': 'NFTSale/contracts',
+    'env': '(load "nft-env.repl")',
+    'setup': mint_setup,
+    'measure': mint_measure,
+  },
+  'nft-mint.add-whitelist-to-collection': {
+    'dir': 'NFTSale/contracts',
+    'env': '(load "nft-env.repl")',
+    'setup': whitelist_setup,
+    'measure': whitelist_measure,
+  },
+  'token-presale.approve-all': {
+    'dir': 'TokenPresale',
+    # The contract enforces free.token-sale-ops for OPS
+    'env': '''
+(load "dependencies/dependencies.repl")
+(begin-tx)
+(env-keys ["bank" "gov" "ops"])
+(env-data
+  { "token-bank-admin": { "keys": ["bank"], "pred": "keys-all" }
+  , "token-sale-gov": { "keys": ["gov"], "pred": "keys-all" }
+  , "token-sale-ops": { "keys": ["ops"], "pred": "keys-all" }
+  , "upgrade": true
+  })
+(namespace "free")
+(define-keyset "free.token-sale-ops" (read-keyset "token-sale-ops"))
+(load "token-presale.pact")
+(commit-tx)
+''',
+    'setup': approve_all_setup,
+    'measure': approve_all_measure,
+  },
+  'airdrop.airdrop-coin': {
+    'dir': 'Airdrop',
+    'env': '''
+(load "kda-env/init.repl")
+(begin-tx)
+(env-keys ["gov" "alice-key"])
+(env-data
+  { "gov": { "keys": ["gov"], "pred": "=" }
+  , "alice": { "keys": ["alice-key"], "pred": "=" }
+  , "init": true
+  })
+(load "airdrop.pact")
+(free.airdrop.create-managed-account "gas-drop" (read-keyset "alice") "alice")
+(env-sigs [{ "key": "alice-key", "caps": [(free.airdrop.MANAGED "gas-drop")] }])
+(free.airdrop.add-coin-to-managed-account "gas-drop" coin)
+(commit-tx)
+''',
+    'setup': airdrop_setup,
+    'measure': airdrop_measure,
+  },
+  'marmalade-nft-staking.set-pool-bonus': {
+    'dir': 'NFTStaking',
+    'env': '''
+(load "dependencies/dependencies.repl")
+(begin-tx)
+(env-keys ["admin" "ops"])
+(env-data
+  { "gov": { "keys": ["admin"], "pred": "=" }
+  , "ops": { "keys": ["ops"], "pred": "=" }
+  , "init": true
+  })
+(load "marmalade-nft-staking.pact")
+(commit-tx)
+''',
+    'setup': pool_bonus_setup,
+    'measure': pool_bonus_measure,
+  },
+}
+
+
+def scenario_script(scenario, sizes):
+  """The repl script for every size of a scenario. Each size runs in
+  its own transaction and is rolled back, so sizes don't see each other."""
+  parts = [scenario['env'].strip(), '(env-gasmodel "table")']
+  for n in sizes:
+    parts.append(f'''
+(begin-tx "gas {n}")
+(env-gaslimit {PROFILE_GAS_LIMIT})
+{scenario['setup'](n).strip()}
+(env-gas 0)
+{scenario['measure'](n)}
+(env-gas)
+"{MARKER}{n}"
+(rollback-tx)''')
+  return '\n'.join(parts) + '\n'
+
+
+# -------------------------------
+# Running
+
+def parse_output(output, sizes):
+  """Reads the gas printed before each size's marker.
+  Returns ({ size: gas }, { size: error lines })."""
+  lines = [l.strip() for l in output.splitlines()]
+  gas = {}
+  errors = {}
+  start = 0
+  for n in sizes:
+    marker = f'"{MARKER}{n}"'
+    end = next((i for i in range(start, len(lines)) if lines[i].endswith(marker)), None)
+    if end is None:
+      errors[n] = ['Scenario stopped before this size']
+      break
+    block = lines[start:end]
+    failed = [l for l in block if l.startswith('<interactive>') or 'Error' in l or 'Failure' in l]
+    match = re.search(r'(\d+)$', block[-1]) if block else None
+    if failed or not match:
+      errors[n] = failed or block[-3:]
+    else:
+      gas[n] = int(match.group(1))
+    start = end + 1
+  return gas, errors
+
+
+def run_scenario(pact, name, sizes, timeout=TIMEOUT):
+  """Runs the scenario in a pact repl from the scenario's directory.
+  Returns (gas, errors) as parse_output does."""
+  scenario = SCENARIOS[name]
+  try:
+    proc = subprocess.run([pact], input=scenario_script(scenario, sizes),
+      cwd=os.path.join(ROOT, scenario['dir']), capture_output=True, text=True, timeout=timeout)
+  except subprocess.TimeoutExpired:
+    return {}, { n: [f'Timed out after {timeout}s'] for n in sizes }
+  return parse_output(proc.stdout + proc.stderr, sizes)
+
+
+# -------------------------------
+# Fitting
+
+def fit(gas):
+  """Fits gas = base + per_item * n with least squares, and the growth
+  exponent k of the gas above the smallest size, ~ (n - n0) ^ k.
+  k is about 1 for linear paths, 2 for quadratic and 0 for flat ones."""
+  sizes = sorted(gas)
+  xs = sizes
+  ys = [gas[n] for n in sizes]
+  count = len(xs)
+  mean_x = sum(xs) / count
+  mean_y = sum(ys) / count
+  var_x = sum((x - mean_x) ** 2 for x in xs)
+  per_item = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x if var_x else 0.0
+  base = mean_y - per_item * mean_x
+
+  n0, g0 = xs[0], ys[0]
+  points = [(math.log(x - n0), math.log(y - g0)) for x, y in zip(xs, ys) if x > n0 and y - g0 > 0]
+  # Flat if the gas barely moves across the sizes
+  if len(points) < 2 or ys[-1] - g0 < 0.01 * g0:
+    exponent = 0.0
+  else:
+    mx = sum(p[0] for p in points) / len(points)
+    my = sum(p[1] for p in points) / len(points)
+    vx = sum((p[0] - mx) ** 2 for p in points)
+    exponent = sum((p[0] - mx) * (p[1] - my) for p in points) / vx if vx else 0.0
+
+  max_items = int((MAX_GAS - base) / per_item) if per_item > 0 else None
+  return {
+    'base': round(base, 2),
+    'per_item': round(per_item, 2),
+    'exponent': round(exponent, 3),
+    'max_items': max_items,
+    'gas': { str(n): gas[n] for n in sizes },
+  }
+
+
+def compare(name, current, baseline, tolerance=TOLERANCE):
+  """Returns the ways current scales worse than baseline."""
+  problems = []
+  if current['exponent'] > baseline['exponent'] + EXPONENT_TOLERANCE:
+    problems.append(f'grows as n^{current["exponent"]}, was n^{baseline["exponent"]}')
+  if current['per_item'] > baseline['per_item'] * (1 + tolerance) + 1:
+    problems.append(f'{current["per_item"]} gas per item, was {baseline["per_item"]}')
+  for n, gas in current['gas'].items():
+    old = baseline['gas'].get(n)
+    if old is not None and gas > old * (1 + tolerance):
+      problems.append(f'{gas} gas at n={n}, was {old}')
+  return [f'{name}: {p}' for p in problems]
+
+
+def read_baseline(path):
+  if not os.path.exists(path):
+    return {}
+  with open(path, 'r') as f:
+    return json.load(f)
+
+
+def write_baseline(path, results):
+  with open(path, 'w') as f:
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.write('\n')
+
+
+def profile(pact, names, sizes, workers=None):
+  """Runs the scenarios in parallel. Returns ({ name: fit }, { name: errors })."""
+  results = {}
+  errors = {}
+  with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+    futures = { executor.submit(run_scenario, pact, name, sizes): name for name in names }
+    for future in as_completed(futures):
+      name = futures[future]
+      gas, failed = future.result()
+      if failed:
+        errors[name] = failed
+      if len(gas) >= 2:
+        results[name] = fit(gas)
+  return results, errors
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('scenarios', nargs='*', help=f'Scenarios to run, all by default: {", ".join(SCENARIOS)}')
+  parser.add_argument('-n', type=int, nargs='+', default=SIZES, help='Sizes to measure')
+  parser.add_argument('-b', default=BASELINE, help='Baseline file')
+  parser.add_argument('-j', type=int, default=os.cpu_count(), help='Scenarios run at once')
+  parser.add_argument('--pact', default=shutil.which('pact'), help='Path to the pact binary')
+  parser.add_argument('--update', action='store_true', help='Save the results as the new baseline')
+  parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+    help='Fraction a fit can get worse than the baseline before failing')
+  parser.add_argument('--emit', help='Write the generated repl scripts to this directory and exit')
+  args = parser.parse_args()
+
+  names = args.scenarios or list(SCENARIOS)
+  sizes = sorted(set(args.n))
+  if args.emit:
+    os.makedirs(args.emit, exist_ok=True)
+    for name in names:
+      with open(os.path.join(args.emit, f'{name}.repl'), 'w') as f:
+        f.write(scenario_script(SCENARIOS[name], sizes))
+    sys.exit(0)
+  if not args.pact:
+    sys.exit('No pact binary found, install pact or pass --pact')
+
+  results, errors = profile(args.pact, names, sizes, args.j)
+  for name in names:
+    if name in results:
+      r = results[name]
+      limit = r['max_items'] if r['max_items'] is not None else 'no limit'
+      print(f'{name}: {r["base"]} + {r["per_item"]} * n gas, ~n^{r["exponent"]}, '
+        f'max n under {MAX_GAS} gas: {limit}')
+    for n, lines in errors.get(name, {}).items():
+      print(f'{name} n={n} failed: {" ".join(lines)}')
+
+  baseline = read_baseline(args.b)
+  if args.update:
+    write_baseline(args.b, { **baseline, **results })
+    print(f'Baseline saved to {args.b}')
+    sys.exit(1 if errors else 0)
+
+  problems = []
+  for name, current in results.items():
+    if name in baseline:
+      problems.extend(compare(name, current, baseline[name], args.tolerance))
+    else:
+      print(f'{name}: no baseline, run with --update to save one')
+  for problem in problems:
+    print(f'Regression: {problem}')
+  sys.exit(1 if problems or errors else 0)
@@ -0,0 +1,441 @@
+import os
+import json
+import time
+import base64
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from fanout import create_session
+
+MAINNET = {
+  'base_url': 'https://api.chainweb.com',
+  'chain_ids': ['1'],
+}
+TESTNET = {
+  'base_url': 'https://api.testnet.chainweb.com',
+  'chain_ids': ['1'],
+}
+NETWORK = TESTNET
+# KADENA_NODE_URL points the script at another node, e.g. local_chainweb.py
+BASE_URL = os.environ.get('KADENA_NODE_URL', NETWORK['base_url'])
+
+# Blocks are only indexed once they are this far below the tip,
+# so a fork near the tip never makes it into the db
+CONFIRMATION_DEPTH = 6
+# Block heights read per request
+WINDOW = 100
+# Seconds between syncs with --follow
+FOLLOW_INTERVAL = 30
+# Modules whose events are indexed
+MODULES = [
+  'free.nft-mint',
+  'free.marmalade-nft-staking',
+  'free.marmalade-nft-bonding',
+  'free.token-sale-manager',
+  'free.airdrop',
+]
+# Headers as json objects instead of base64
+HEADER_ACCEPT = 'application/json;blockheader-encoding=object'
+
+SCHEMA = '''
+  CREATE TABLE IF NOT EXISTS progress (
+    chain_id TEXT PRIMARY KEY,
+    height INTEGER
+  );
+  CREATE TABLE IF NOT EXISTS events (
+    chain_id TEXT,
+    height INTEGER,
+    block_hash TEXT,
+    request_key TEXT,
+    idx INTEGER,
+    module TEXT,
+    name TEXT,
+    params TEXT,
+    PRIMARY KEY (chain_id, request_key, idx)
+  );
+  CREATE INDEX IF NOT EXISTS events_by_name ON events (module, name, height);
+
+  CREATE TABLE IF NOT EXISTS tokens (
+    chain_id TEXT,
+    collection TEXT,
+    token_id INTEGER,
+    account TEXT,
+    revealed INTEGER,
+    marmalade_token_id TEXT,
+    PRIMARY KEY (chain_id, collection, token_id)
+  );
+  CREATE INDEX IF NOT EXISTS tokens_by_account ON tokens (account, collection, token_id);
+  CREATE INDEX IF NOT EXISTS tokens_by_revealed ON tokens (collection, revealed, token_id);
+
+  CREATE TABLE IF NOT EXISTS pools (
+    chain_id TEXT,
+    pool_name TEXT,
+    token_id TEXT,
+    status TEXT,
+    PRIMARY KEY (chain_id, pool_name)
+  );
+  CREATE INDEX IF NOT EXISTS pools_by_status ON pools (status);
+
+  CREATE TABLE IF NOT EXISTS stakes (
+    chain_id TEXT,
+    pool_name TEXT,
+    account TEXT,
+    amount REAL,
+    PRIMARY KEY (chain_id, pool_name, account)
+  );
+  CREATE INDEX IF NOT EXISTS stakes_by_account ON stakes (account);
+
+  CREATE TABLE IF NOT EXISTS claims (
+    chain_id TEXT,
+    request_key TEXT,
+    module TEXT,
+    pool_name TEXT,
+    account TEXT,
+    amount REAL,
+    height INTEGER
+  );
+  CREATE INDEX IF NOT EXISTS claims_by_account ON claims (account, module, pool_name);
+
+  CREATE TABLE IF NOT EXISTS reservations (
+    chain_id TEXT,
+    reservation_id TEXT,
+    sale TEXT,
+    account TEXT,
+    amount_token REAL,
+    status TEXT,
+    PRIMARY KEY (chain_id, reservation_id)
+  );
+  CREATE INDEX IF NOT EXISTS reservations_by_sale ON reservations (sale, status);
+  CREATE INDEX IF NOT EXISTS reservations_by_account ON reservations (account, sale);
+
+  CREATE TABLE IF NOT EXISTS managed_accounts (
+    chain_id TEXT,
+    account TEXT,
+    k_account TEXT,
+    PRIMARY KEY (chain_id, account)
+  );
+  CREATE INDEX IF NOT EXISTS managed_accounts_by_k ON managed_accounts (k_account);
+
+  CREATE TABLE IF NOT EXISTS airdrops (
+    chain_id TEXT,
+    request_key TEXT,
+    managed_account TEXT,
+    sender TEXT,
+    token_id TEXT,
+    amount REAL,
+    recipients INTEGER,
+    height INTEGER
+  );
+  CREATE INDEX IF NOT EXISTS airdrops_by_account ON airdrops (managed_account);
+'''
+
+
+def decode(payload):
+  """Decodes chainweb's unpadded base64url json."""
+  return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+
+
+def pact_value(value):
+  """Unwraps the { int } and { decimal } objects the Pact API uses for big numbers."""
+  if isinstance(value, dict):
+    if 'int' in value and len(value) == 1:
+      return int(value['int'])
+    if 'decimal' in value and len(value) == 1:
+      return float(value['decimal'])
+    return { k: pact_value(v) for k, v in value.items() }
+  if isinstance(value, list):
+    return [pact_value(v) for v in value]
+  return value
+
+
+# -------------------------------
+# Views
+# Each handler folds one event into the tables the getters read.
+# They get (db, chain_id, event), where event has params, request_key and height.
+
+def on_mint_range(db, chain_id, event):
+  collection, account, token_id, amount = event['params']
+  db.executemany('INSERT OR IGNORE INTO tokens VALUES (?, ?, ?, ?, 0, NULL)',
+    [(chain_id, collection, i, account) for i in range(token_id, token_id + amount)])
+
+
+def on_reveal(db, chain_id, event):
+  collection, token_id, account, marmalade_token_id = event['params']
+  db.execute('''
+    UPDATE tokens SET revealed = 1, marmalade_token_id = ?
+    WHERE chain_id = ? AND collection = ? AND token_id = ?''',
+    (marmalade_token_id, chain_id, collection, token_id))
+
+
+def on_pool(db, chain_id, event):
+  pool_name, token_id, status = event['params']
+  db.execute('''
+    INSERT INTO pools VALUES (?, ?, ?, ?)
+    ON CONFLICT (chain_id, pool_name) DO UPDATE SET status = excluded.status''',
+    (chain_id, pool_name, token_id, status))
+
+
+def stake_change(sign):
+  def on_stake(db, chain_id, event):
+    pool_name, account, amount = event['params']
+    db.execute('''
+      INSERT INTO stakes VALUES (?, ?, ?, ?)
+      ON CONFLICT (chain_id, pool_name, account) DO UPDATE SET amount = amount + excluded.amount''',
+      (chain_id, pool_name, account, sign * amount))
+  return on_stake
+
+
+def claim_for(module):
+  def on_claim(db, chain_id, event):
+    pool_name, account, amount = event['params']
+    db.execute('INSERT INTO claims VALUES (?, ?, ?, ?, ?, ?, ?)',
+      (chain_id, event['request_key'], module, pool_name, account, amount, event['height']))
+  return on_claim
+
+
+def on_reservation(db, chain_id, event):
+  reservation_id, sale, account, amount_token, status = event['params']
+  db.execute('''
+    INSERT INTO reservations VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (chain_id, reservation_id) DO UPDATE SET status = excluded.status''',
+    (chain_id, reservation_id, sale, account, amount_token, status))
+
+
+def on_managed_account(db, chain_id, event):
+  account, k_account = event['params']
+  db.execute('INSERT OR IGNORE INTO managed_accounts VALUES (?, ?, ?)', (chain_id, account, k_account))
+
+
+def on_airdrop(db, chain_id, event):
+  managed_account, sender, token_id, amount, recipients = event['params']
+  db.execute('INSERT INTO airdrops VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+    (chain_id, event['request_key'], managed_account, sender, token_id, amount, recipients, event['height']))
+
+
+# (module name without the namespace, event name) -> handler
+HANDLERS = {
+  ('nft-mint', 'MINT_RANGE_EVENT'): on_mint_range,
+  ('nft-mint', 'REVEAL_EVENT'): on_reveal,
+  ('marmalade-nft-staking', 'POOL_EVENT'): on_pool,
+  ('marmalade-nft-staking', 'STAKE_EVENT'): stake_change(1),
+  ('marmalade-nft-staking', 'UNSTAKE_EVENT'): stake_change(-1),
+  ('marmalade-nft-staking', 'CLAIM_EVENT'): claim_for('marmalade-nft-staking'),
+  ('marmalade-nft-bonding', 'CLAIM_EVENT'): claim_for('marmalade-nft-bonding'),
+  ('token-sale-manager', 'RESERVATION_EVENT'): on_reservation,
+  ('airdrop', 'MANAGED_ACCOUNT_EVENT'): on_managed_account,
+  ('airdrop', 'AIRDROP_EVENT'): on_airdrop,
+}
+
+# The contract getters, answered from the views
+QUERIES = {
+  'tokens-for-collection': 'SELECT * FROM tokens WHERE collection = ? ORDER BY token_id',
+  'unrevealed-tokens-for-collection':
+    'SELECT * FROM tokens WHERE collection = ? AND revealed = 0 ORDER BY token_id',
+  'owned': 'SELECT * FROM tokens WHERE account = ? ORDER BY collection, token_id',
+  'owned-for-collection':
+    'SELECT * FROM tokens WHERE account = ? AND collection = ? ORDER BY token_id',
+  'pools': 'SELECT * FROM pools ORDER BY pool_name',
+  'active-pools': "SELECT * FROM pools WHERE status = 'ACTIVE' ORDER BY pool_name",
+  'staked-for-account': 'SELECT * FROM stakes WHERE account = ? AND amount > 0',
+  'claims-for-account': 'SELECT * FROM claims WHERE account = ? ORDER BY height',
+  'reservations': 'SELECT * FROM reservations WHERE sale = ?',
+  'account-reservations': 'SELECT * FROM reservations WHERE account = ? AND sale = ?',
+  'managed-accounts-for-k-account': 'SELECT * FROM managed_accounts WHERE k_account = ?',
+}
+
+
+class EventIndexer():
+  """Reads the events of the repo's contracts block by block and keeps
+  sqlite tables of the state the frontends would otherwise select for.
+
+  Each chain is read from the height it was left at, or from its
+  from_heights entry (the height the contracts were deployed at) the
+  first time, up to the tip minus the confirmation depth, WINDOW heights
+  at a time, using the header branch of the current cut so only blocks on
+  the winning fork are read.
+  A window's events, views and progress are written in one transaction,
+  so an interrupted sync picks up where it stopped.
+
+    indexer = EventIndexer(BASE_URL)
+    indexer.sync(['1'])
+    indexer.query('owned-for-collection', 'k:...', 'my-collection')
+  """
+
+  def __init__(self, base_url, path='events.db', network_id=None, modules=MODULES,
+    depth=CONFIRMATION_DEPTH, window=WINDOW, session=None, from_heights=None):
+    self.base_url = base_url
+    self.modules = set(modules)
+    self.from_heights = from_heights or {}
+    self.depth = depth
+    self.window = window
+    self.session = session or create_session()
+    self._network_id = network_id
+    self.db = sqlite3.connect(path)
+    self.db.row_factory = sqlite3.Row
+    self.db.executescript(SCHEMA)
+
+
+  @property
+  def network_id(self):
+    """Read from the node the first time it's needed, queries don't need it."""
+    if self._network_id is None:
+      self._network_id = self._get(f'{self.base_url}/config')['chainwebVersion']
+    return self._network_id
+
+
+  def _url(self, path):
+    return f'{self.base_url}/chainweb/0.0/{self.network_id}{path}'
+
+
+  def _get(self, url):
+    resp = self.session.get(url)
+    resp.raise_for_status()
+    return resp.json()
+
+
+  def cut(self):
+    return self._get(self._url('/cut'))
+
+
+  def headers(self, chain_id, min_height, max_height, upper):
+    """Headers from min_height to max_height on the branch ending at upper, lowest first."""
+    headers = []
+    params = { 'minheight': min_height, 'maxheight': max_height, 'limit': self.window }
+    while True:
+      resp = self.session.post(self._url(f'/chain/{chain_id}/header/branch'),
+        params=params, json={ 'lower': [], 'upper': [upper] },
+        headers={ 'Accept': HEADER_ACCEPT })
+      resp.raise_for_status()
+      page = resp.json()
+      headers.extend(page['items'])
+      if not page.get('next'):
+        break
+      params['next'] = page['next']
+    return sorted(headers, key=lambda h: h['height'])
+
+
+  def outputs(self, chain_id, payload_hashes):
+    """{ payload hash: [command result] } for the blocks."""
+    if not payload_hashes:
+      return {}
+    resp = self.session.post(self._url(f'/chain/{chain_id}/payload/outputs/batch'), json=payload_hashes)
+    resp.raise_for_status()
+    return {
+      p['payloadHash']: [decode(output) for _, output in p['transactions']]
+      for p in resp.json()
+    }
+
+
+  def height(self, chain_id):
+    """The last height indexed. A chain that hasn't been indexed yet starts
+    below its from height, so the blocks before the deploy aren't read."""
+    row = self.db.execute('SELECT height FROM progress WHERE chain_id = ?', (chain_id,)).fetchone()
+    if row:
+      return row['height']
+    return max(self.from_heights.get(chain_id, 1) - 1, 0)
+
+
+  def fetch(self, chain_id, start, end, upper):
+    """Reads the blocks of a window. Runs on the worker threads, no db access."""
+    headers = self.headers(chain_id, start, end, upper)
+    outputs = self.outputs(chain_id, [h['payloadHash'] for h in headers])
+    return chain_id, end, [(h, outputs.get(h['payloadHash'], [])) for h in headers]
+
+
+  def index(self, chain_id, end, blocks):
+    """Writes a window's events and views and moves the chain to end.
+    Returns the number of new events."""
+    added = 0
+    with self.db:
+      for header, results in blocks:
+        for result in results:
+          for idx, event in enumerate(result.get('events') or []):
+            module = event['module']
+            qualified = f'{module["namespace"]}.{module["name"]}' if module.get('namespace') else module['name']
+            if qualified not in self.modules:
+              continue
+            params = pact_value(event['params'])
+            inserted = self.db.execute('INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+              (chain_id, header['height'], header['hash'], result['reqKey'], idx,
+                qualified, event['name'], json.dumps(params))).rowcount
+            # Already seen events were folded into the views the first time
+            handler = HANDLERS.get((module['name'], event['name']))
+            if inserted and handler:
+              handler(self.db, chain_id, {
+                'params': params,
+                'request_key': result['reqKey'],
+                'height': header['height'],
+              })
+            added += inserted
+      self.db.execute('INSERT OR REPLACE INTO progress VALUES (?, ?)', (chain_id, end))
+    return added
+
+
+  def sync(self, chain_ids):
+    """Indexes every chain up to the confirmed height of the current cut.
+    Chains are read in parallel, the db is written from this thread only."""
+    cut = self.cut()['hashes']
+    targets = { c: (cut[c]['height'] - self.depth, cut[c]['hash']) for c in chain_ids }
+    added = 0
+    with ThreadPoolExecutor(max_workers=len(chain_ids)) as executor:
+      while True:
+        windows = []
+        for chain_id in chain_ids:
+          start = self.height(chain_id) + 1
+          target, upper = targets[chain_id]
+          if start <= target:
+            windows.append((chain_id, start, min(start + self.window - 1, target), upper))
+        if not windows:
+          return added
+        for chain_id, end, blocks in executor.map(lambda w: self.fetch(*w), windows):
+          added += self.index(chain_id, end, blocks)
+
+
+  def follow(self, chain_ids, interval=FOLLOW_INTERVAL):
+    while True:
+      start = time.perf_counter()
+      added = self.sync(chain_ids)
+      heights = { c: self.height(c) for c in chain_ids }
+      print(f'{added} new events in {time.perf_counter() - start:.1f}s, heights {heights}')
+      time.sleep(interval)
+
+
+  def query(self, name, *args):
+    return [dict(row) for row in self.db.execute(QUERIES[name], args)]
+
+
+def parse_from_height(value):
+  """CHAIN:HEIGHT, e.g. 8:3400000."""
+  chain_id, sep, height = value.partition(':')
+  if not sep or not height.isdigit():
+    raise argparse.ArgumentTypeError(f'Expected CHAIN:HEIGHT, got {value}')
+  return chain_id, int(height)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-c', nargs='*', default=NETWORK['chain_ids'], help='Chain ids to index')
+  parser.add_argument('-d', default='events.db', help='Sqlite file')
+  parser.add_argument('-m', nargs='*', default=MODULES, help='Qualified modules to index')
+  parser.add_argument('--depth', type=int, default=CONFIRMATION_DEPTH,
+    help='Blocks below the tip before a block is indexed, 0 for local_chainweb.py')
+  parser.add_argument('--from-height', nargs='*', type=parse_from_height, default=[],
+    metavar='CHAIN:HEIGHT',
+    help='Height to start a chain at when it has not been indexed yet, e.g. the deploy height')
+  parser.add_argument('--follow', action='store_true', help='Keep syncing every interval')
+  parser.add_argument('--interval', type=float, default=FOLLOW_INTERVAL)
+  parser.add_argument('-q', nargs='+', metavar=('QUERY', 'ARG'),
+    help=f'Run a query instead of syncing: {", ".join(QUERIES)}')
+  args = parser.parse_args()
+
+  indexer = EventIndexer(BASE_URL, args.d, modules=args.m, depth=args.depth,
+    from_heights=dict(args.from_height))
+  if args.q:
+    print(json.dumps(indexer.query(*args.q), indent=2))
+  elif args.follow:
+    indexer.follow(args.c, args.interval)
+  else:
+    start = time.perf_counter()
+    added = indexer.sync(args.c)
+    print(f'{added} new events in {time.perf_counter() - start:.1f}s')
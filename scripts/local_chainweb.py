@@ -0,0 +1,591 @@
+"""A local stand-in for the Chainweb Pact API, for benchmarking and load
+testing without touching testnet.
+
+Serves /config and /send, /local, /poll and /listen for every chain under
+/chainweb/0.0/<network>/chain/<chain>/pact/api/v1. Sent transactions are
+"mined" after --block-time seconds, one transaction per block, and the
+blocks can be read back with the cut, header branch and payload outputs
+endpoints, e.g. by indexer.py.
+
+Code is evaluated by a local pact binary with kda-env/init.repl loaded,
+when one is installed, otherwise canned responses are returned.
+Latency and failures can be injected to see how the client stack copes.
+
+Point the scripts and the reveal lambda at it with KADENA_NODE_URL:
+
+  python local_chainweb.py -p 8080
+  KADENA_NODE_URL=http://localhost:8080 python portfolio.py -a k:...
+"""
+import os
+import re
+import json
+import time
+import base64
+import random
+import shutil
+import argparse
+import threading
+import subprocess
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from kadena_sdk import blake_hash
+
+KDA_ENV = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kda-env')
+ROUTE = re.compile(r'^/chainweb/0\.0/([^/]+)/chain/(\d+)/pact/api/v1/(send|local|poll|listen)$')
+CUT_ROUTE = re.compile(r'^/chainweb/0\.0/([^/]+)/cut$')
+BRANCH_ROUTE = re.compile(r'^/chainweb/0\.0/([^/]+)/chain/(\d+)/header/branch$')
+OUTPUTS_ROUTE = re.compile(r'^/chainweb/0\.0/([^/]+)/chain/(\d+)/payload/outputs/batch$')
+
+# Canned gas: a fixed cost plus a cost per byte of code and data,
+# so bigger batches cost more like they do on chain
+CANNED_BASE_GAS = 300
+CANNED_BYTES_PER_GAS = 4
+LISTEN_TIMEOUT = 180
+
+
+# -------------------------------
+# Evaluators
+
+class CannedEvaluator():
+  """Returns canned results without running the code.
+  responses maps a substring of the code to the data to return."""
+
+  def __init__(self, responses=None):
+    self.responses = responses or {}
+
+
+  def evaluate(self, cmd, commit):
+    exec_payload = cmd['payload'].get('exec') or {}
+    code = exec_payload.get('code', '')
+    data = exec_payload.get('data') or {}
+    gas = CANNED_BASE_GAS + (len(code) + len(json.dumps(data))) // CANNED_BYTES_PER_GAS
+
+    for match, response in self.responses.items():
+      if match in code:
+        return { 'status': 'success', 'data': response }, gas, []
+    return { 'status': 'success', 'data': 'Write succeeded' }, gas, []
+
+
+def pact_value(value):
+  """Formats a json cap argument as a pact literal."""
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  if isinstance(value, int):
+    return str(value)
+  if isinstance(value, float):
+    s = repr(value)
+    return s if '.' in s or 'e' in s else f'{s}.0'
+  if isinstance(value, list):
+    return '[' + ' '.join(pact_value(v) for v in value) + ']'
+  if isinstance(value, dict):
+    if 'int' in value and len(value) == 1:
+      return str(value['int'])
+    if 'decimal' in value and len(value) == 1:
+      return value['decimal']
+    return '{' + ', '.join(f'{json.dumps(k)}: {pact_value(v)}' for k, v in value.items()) + '}'
+  return json.dumps(value)
+
+
+_PACT_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.S)
+_PACT_NUMBER = re.compile(r'-?\d+(\.\d+)?(?![^\s,\]}])')
+_PACT_WORD = re.compile(r'[^\s,\[\]{}:"]+')
+
+
+def _skip(text, i):
+  while i < len(text) and text[i] in ' \t\r\n,':
+    i += 1
+  return i
+
+
+def _read_pact(text, i):
+  """Reads the value starting at i, returns (value, end)."""
+  c = text[i]
+  if c == '"':
+    match = _PACT_STRING.match(text, i)
+    try:
+      return json.loads(match.group()), match.end()
+    except ValueError:
+      return match.group()[1:-1], match.end()
+  if c == '[':
+    items = []
+    i = _skip(text, i + 1)
+    while text[i] != ']':
+      value, i = _read_pact(text, i)
+      items.append(value)
+      i = _skip(text, i)
+    return items, i + 1
+  if c == '{':
+    obj = {}
+    i = _skip(text, i + 1)
+    while text[i] != '}':
+      key, i = _read_pact(text, i)
+      i = _skip(text, i)
+      if text[i] != ':':
+        raise ValueError(f'Expected : at {i}')
+      value, i = _read_pact(text, _skip(text, i + 1))
+      obj[key] = value
+      i = _skip(text, i)
+    return obj, i + 1
+
+  number = _PACT_NUMBER.match(text, i)
+  if number:
+    value = float(number.group()) if number.group(1) else int(number.group())
+    return value, number.end()
+  word = _PACT_WORD.match(text, i)
+  if word is None:
+    raise ValueError(f'Unexpected {c!r} at {i}')
+  if word.group() in ['true', 'false']:
+    return word.group() == 'true', word.end()
+  # Guards and the like print as a word and a {...}, keep their text
+  end = word.end()
+  if text.startswith(' {', end):
+    depth = 0
+    for j in range(end + 1, len(text)):
+      depth += { '{': 1, '}': -1 }.get(text[j], 0)
+      if depth == 0:
+        end = j + 1
+        break
+  return text[i:end], end
+
+
+def read_pact_value(text):
+  """Parses a value printed by the pact repl into json types.
+  Anything that isn't a literal (guards, modrefs) is kept as text."""
+  return _read_pact(text, _skip(text, 0))[0]
+
+
+def api_event(event):
+  """An env-events entry in the format of the Pact API."""
+  qualified, _, name = event['name'].rpartition('.')
+  namespace, _, module = qualified.rpartition('.')
+  return {
+    'name': name,
+    'module': { 'name': module, 'namespace': namespace or None },
+    'params': event['params'],
+    'moduleHash': event.get('module-hash', ''),
+  }
+
+
+class PactEvaluator():
+  """Evaluates code in a long running pact repl with kda-env loaded,
+  so init.repl is only loaded once. Transactions run one at a time."""
+
+  MARKER = '@@'
+
+  def __init__(self, pact_path, kda_env=KDA_ENV):
+    self.lock = threading.Lock()
+    self.process = subprocess.Popen([pact_path],
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+      text=True, bufsize=1, cwd=kda_env)
+    self._run('(load "init.repl")', 'READY')
+
+
+  def _run(self, script, marker):
+    """Writes the script followed by a marker string, returns the output lines before it."""
+    self.process.stdin.write(f'{script}\n"{self.MARKER}{marker}"\n')
+    self.process.stdin.flush()
+    lines = []
+    for line in self.process.stdout:
+      line = line.strip()
+      if line == f'"{self.MARKER}{marker}"':
+        return lines
+      lines.append(line)
+    raise Exception('pact exited')
+
+
+  def evaluate(self, cmd, commit):
+    exec_payload = cmd['payload'].get('exec')
+    if exec_payload is None:
+      return { 'status': 'failure', 'error': { 'message': 'Only exec payloads are supported' } }, 0, []
+
+    meta = cmd['meta']
+    sigs = ' '.join(
+      f'{{ "key": {json.dumps(s["pubKey"])}, "caps": ['
+      + ' '.join(f'({c["name"]} {" ".join(pact_value(a) for a in c["args"])})' for c in s.get('clist', []))
+      + '] }'
+      for s in cmd['signers'])
+    setup = '\n'.join([
+      '(begin-tx)',
+      f'(env-data {pact_value(exec_payload.get("data") or {})})',
+      f'(env-sigs [{sigs}])',
+      f'(env-chain-data {{ "chain-id": {json.dumps(meta["chainId"])}, '
+        f'"sender": {json.dumps(meta["sender"])}, "gas-limit": {int(meta["gasLimit"])} }})',
+      '(env-gasmodel "table")',
+      f'(env-gaslimit {int(meta["gasLimit"])})',
+      '(env-gas 0)',
+      '(env-events true)',
+    ])
+
+    with self.lock:
+      self._run(setup, 'CODE')
+      output = self._run(exec_payload['code'], 'GAS')
+      gas_output = self._run('(env-gas)', 'EVENTS')
+      events_output = self._run('(env-events true)', 'DONE')
+      failed = any(l.startswith('<interactive>') or 'Error' in l or 'Failure' in l for l in output)
+      self._run('(commit-tx)' if commit and not failed else '(rollback-tx)', 'END')
+
+    try:
+      gas = int(gas_output[-1])
+    except (IndexError, ValueError):
+      gas = 0
+    if failed:
+      return { 'status': 'failure', 'error': { 'message': '\n'.join(output) } }, gas, []
+
+    data = output[-1] if output else None
+    try:
+      data = json.loads(data)
+    except (TypeError, ValueError):
+      pass
+    try:
+      events = [api_event(e) for e in read_pact_value(' '.join(events_output))]
+    except (IndexError, ValueError, KeyError, TypeError):
+      events = []
+    return { 'status': 'success', 'data': data }, gas, events
+
+
+# -------------------------------
+# Chains
+
+def b64(value):
+  """Unpadded base64url of the json, the encoding chainweb uses for payloads."""
+  return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+
+class Chain():
+  """The transactions sent to one chain and when they are mined."""
+
+  def __init__(self, chain_id):
+    self.chain_id = chain_id
+    self.results = {} # request key -> (mined_at, result)
+    self.blocks = [] # { header, mined_at, signed, result }, in height order
+    self.height = 0
+    self.condition = threading.Condition()
+
+
+  def add(self, signed, result, mined_at):
+    request_key = signed['hash']
+    height = result['metaData']['blockHeight']
+    with self.condition:
+      self.results[request_key] = (mined_at, result)
+      self.blocks.append({
+        'header': {
+          'chainId': int(self.chain_id),
+          'height': height,
+          'hash': blake_hash(f'{self.chain_id}:{height}:{request_key}'),
+          'payloadHash': blake_hash(f'payload:{request_key}'),
+          'creationTime': int(mined_at * 1e6),
+        },
+        'mined_at': mined_at,
+        'signed': signed,
+        'result': result,
+      })
+      self.condition.notify_all()
+
+
+  def mined_blocks(self):
+    now = time.time()
+    with self.condition:
+      return [b for b in self.blocks if b['mined_at'] <= now]
+
+
+  def get(self, request_key):
+    entry = self.results.get(request_key)
+    if entry is None or entry[0] > time.time():
+      return None
+    return entry[1]
+
+
+  def wait(self, request_key, timeout):
+    """Blocks until the request key is mined, for /listen."""
+    deadline = time.time() + timeout
+    with self.condition:
+      while True:
+        entry = self.results.get(request_key)
+        now = time.time()
+        if entry is not None and entry[0] <= now:
+          return entry[1]
+        if now >= deadline:
+          return None
+        wait_for = deadline - now if entry is None else min(entry[0] - now, deadline - now)
+        self.condition.wait(max(wait_for, 0.001))
+
+
+class LocalChainweb():
+
+  def __init__(self, evaluator, network_id='development', chains=20,
+    block_time=2.0, latency=0.0, jitter=0.0, error_rate=0.0, tx_failure_rate=0.0):
+    self.evaluator = evaluator
+    self.network_id = network_id
+    self.chains = { str(i): Chain(str(i)) for i in range(chains) }
+    self.block_time = block_time
+    self.latency = latency
+    self.jitter = jitter
+    self.error_rate = error_rate
+    self.tx_failure_rate = tx_failure_rate
+
+
+  def delay(self):
+    wait = self.latency + random.uniform(-self.jitter, self.jitter)
+    if wait > 0:
+      time.sleep(wait)
+
+
+  def execute(self, signed, chain_id, commit):
+    """Checks and runs a signed command, returns its command result."""
+    if blake_hash(signed['cmd']) != signed['hash']:
+      raise ValueError(f'Invalid transaction hash: {signed["hash"]}')
+    cmd = json.loads(signed['cmd'])
+    if cmd['meta']['chainId'] != chain_id:
+      raise ValueError(f'Chain id mismatch: {cmd["meta"]["chainId"]} sent to chain {chain_id}')
+    if cmd['networkId'] != self.network_id:
+      raise ValueError(f'Network id mismatch: {cmd["networkId"]}')
+
+    result, gas, events = self.evaluator.evaluate(cmd, commit)
+    if gas > cmd['meta']['gasLimit']:
+      result, gas = {
+        'status': 'failure',
+        'error': { 'message': f'Gas limit ({cmd["meta"]["gasLimit"]}) exceeded: {gas}' },
+      }, cmd['meta']['gasLimit']
+    elif commit and random.random() < self.tx_failure_rate:
+      result = { 'status': 'failure', 'error': { 'message': 'Injected failure' } }
+    if result['status'] != 'success':
+      events = []
+
+    chain = self.chains[chain_id]
+    return {
+      'reqKey': signed['hash'],
+      'result': result,
+      'gas': gas,
+      'logs': blake_hash(json.dumps(result)),
+      'txId': None,
+      'metaData': {
+        'blockHeight': chain.height,
+        'blockTime': int(time.time() * 1e6),
+        'publicMeta': cmd['meta'],
+      },
+      'continuation': None,
+      'events': events,
+    }
+
+
+  def send(self, chain_id, body):
+    cmds = body['cmds']
+    chain = self.chains[chain_id]
+    # Sends are handled on several threads. The check, the heights and the
+    # blocks have to be one step, or two sends could get the same height,
+    # add their blocks out of order, or both get a duplicate through.
+    # The condition's lock is reentrant, so add takes it again.
+    with chain.condition:
+      hashes = [signed['hash'] for signed in cmds]
+      for request_key in hashes:
+        if request_key in chain.results or hashes.count(request_key) > 1:
+          raise ValueError(f'Transaction already exists: {request_key}')
+
+      mined_at = time.time() + self.block_time
+      for signed in cmds:
+        chain.height += 1
+        chain.add(signed, self.execute(signed, chain_id, True), mined_at)
+    return { 'requestKeys': hashes }
+
+
+  def local(self, chain_id, body):
+    return self.execute(body, chain_id, False)
+
+
+  def poll(self, chain_id, body):
+    chain = self.chains[chain_id]
+    results = {}
+    for request_key in body['requestKeys']:
+      result = chain.get(request_key)
+      if result is not None:
+        results[request_key] = result
+    return results
+
+
+  def listen(self, chain_id, body):
+    result = self.chains[chain_id].wait(body['listen'], LISTEN_TIMEOUT)
+    if result is None:
+      raise TimeoutError(f'Timed out listening for {body["listen"]}')
+    return result
+
+
+  # -------------------------------
+  # Blocks
+
+  def cut(self):
+    hashes = {}
+    for chain_id, chain in self.chains.items():
+      blocks = chain.mined_blocks()
+      hashes[chain_id] = {
+        'height': blocks[-1]['header']['height'] if blocks else 0,
+        'hash': blocks[-1]['header']['hash'] if blocks else blake_hash(f'{chain_id}:genesis'),
+      }
+    return {
+      'hashes': hashes,
+      'height': sum(h['height'] for h in hashes.values()),
+      'instance': self.network_id,
+      'id': '',
+    }
+
+
+  def branch(self, chain_id, min_height, max_height, limit, next_page=None):
+    """Mined headers between the heights, highest first like chainweb.
+    There are no forks here, so the branch bounds in the body are ignored."""
+    headers = [b['header'] for b in reversed(self.chains[chain_id].mined_blocks())
+      if min_height <= b['header']['height'] <= max_height]
+    if next_page:
+      hashes = [h['hash'] for h in headers]
+      start = next_page.split(':', 1)[1]
+      headers = headers[hashes.index(start):] if start in hashes else []
+    items = headers[:limit]
+    return {
+      'items': items,
+      'limit': len(items),
+      'next': f'inclusive:{headers[limit]["hash"]}' if len(headers) > limit else None,
+    }
+
+
+  def outputs(self, chain_id, payload_hashes):
+    blocks = { b['header']['payloadHash']: b for b in self.chains[chain_id].mined_blocks() }
+    return [{
+      'payloadHash': payload_hash,
+      'transactions': [[b64(blocks[payload_hash]['signed']), b64(blocks[payload_hash]['result'])]],
+      'minerData': b64({}),
+      'coinbase': b64({}),
+    } for payload_hash in payload_hashes if payload_hash in blocks]
+
+
+def make_handler(node, quiet=True):
+
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, without this keep-alive
+    # clients wait out the delayed ack on every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+      if not quiet:
+        super().log_message(*args)
+
+
+    def respond(self, code, body):
+      data = (body if isinstance(body, str) else json.dumps(body)).encode()
+      self.send_response(code)
+      self.send_header('Content-Type', 'application/json' if not isinstance(body, str) else 'text/plain')
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+
+    def do_GET(self):
+      cut = CUT_ROUTE.match(self.path.split('?')[0])
+      if self.path.rstrip('/') == '/config':
+        self.respond(200, { 'chainwebVersion': node.network_id })
+      elif cut and cut.group(1) == node.network_id:
+        self.respond(200, node.cut())
+      else:
+        self.respond(404, 'Not found')
+
+
+    def blocks(self, path, raw):
+      """The header branch and payload outputs endpoints."""
+      outputs = OUTPUTS_ROUTE.match(path)
+      network_id, chain_id = (outputs or BRANCH_ROUTE.match(path)).groups()
+      if network_id != node.network_id or chain_id not in node.chains:
+        return self.respond(404, 'Not found')
+
+      node.delay()
+      query = parse_qs(urlparse(self.path).query)
+      try:
+        if outputs:
+          return self.respond(200, node.outputs(chain_id, json.loads(raw)))
+        return self.respond(200, node.branch(chain_id,
+          int(query.get('minheight', [0])[0]),
+          int(query.get('maxheight', [2 ** 62])[0]),
+          int(query.get('limit', [1000])[0]),
+          query.get('next', [None])[0]))
+      except (ValueError, TypeError) as e:
+        return self.respond(400, f'Validation failed: {e}')
+
+
+    def do_POST(self):
+      length = int(self.headers.get('Content-Length', 0))
+      raw = self.rfile.read(length)
+      path = self.path.split('?')[0]
+      if BRANCH_ROUTE.match(path) or OUTPUTS_ROUTE.match(path):
+        return self.blocks(path, raw)
+      match = ROUTE.match(path)
+      if match is None:
+        return self.respond(404, 'Not found')
+
+      network_id, chain_id, endpoint = match.groups()
+      if network_id != node.network_id or chain_id not in node.chains:
+        return self.respond(404, 'Not found')
+
+      node.delay()
+      if random.random() < node.error_rate:
+        return self.respond(503, 'Injected error')
+
+      try:
+        body = json.loads(raw)
+        self.respond(200, getattr(node, endpoint)(chain_id, body))
+      except TimeoutError as e:
+        self.respond(408, str(e))
+      except (ValueError, KeyError, TypeError) as e:
+        self.respond(400, f'Validation failed: {e}')
+
+  return Handler
+
+
+def create_evaluator(pact=None, canned=None):
+  """A pact evaluator when a pact binary can be found, otherwise canned responses."""
+  pact_path = pact or shutil.which('pact')
+  if pact_path and not canned:
+    return PactEvaluator(pact_path)
+
+  responses = None
+  if canned:
+    with open(canned, 'r') as f:
+      responses = json.load(f)
+  return CannedEvaluator(responses)
+
+
+def serve(node, host='127.0.0.1', port=8080, quiet=True):
+  server = ThreadingHTTPServer((host, port), make_handler(node, quiet))
+  server.daemon_threads = True
+  return server
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-p', type=int, default=8080, help='Port')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('-n', default='development', help='Network id')
+  parser.add_argument('--chains', type=int, default=20)
+  parser.add_argument('--block-time', type=float, default=2.0,
+    help='Seconds before a sent transaction shows up in /poll and /listen')
+  parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+  parser.add_argument('--jitter', type=float, default=0.0, help='Random +/- seconds on the latency')
+  parser.add_argument('--error-rate', type=float, default=0.0,
+    help='Fraction of requests answered with a 503')
+  parser.add_argument('--tx-failure-rate', type=float, default=0.0,
+    help='Fraction of sent transactions that fail on chain')
+  parser.add_argument('--pact', help='Path to the pact binary, found on the PATH by default')
+  parser.add_argument('--canned', help='Json file of { code substring: data } responses, skips pact')
+  parser.add_argument('-v', action='store_true', help='Log every request')
+  args = parser.parse_args()
+
+  evaluator = create_evaluator(args.pact, args.canned)
+  node = LocalChainweb(evaluator,
+    network_id=args.n,
+    chains=args.chains,
+    block_time=args.block_time,
+    latency=args.latency,
+    jitter=args.jitter,
+    error_rate=args.error_rate,
+    tx_failure_rate=args.tx_failure_rate)
+  server = serve(node, args.host, args.p, quiet=not args.v)
+  print(f'Serving {args.chains} chains of {args.n} on http://{args.host}:{args.p} '
+    f'with {type(evaluator).__name__}')
+  server.serve_forever()
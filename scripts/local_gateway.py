@@ -0,0 +1,449 @@
+"""A read-through cache in front of the Pact /local endpoint.
+
+Frontends and bots call the same read-only getters over and over. The
+gateway answers repeated /local calls for the functions in TTLS from
+memory, keyed by (chain, code, data), until the function's TTL runs out
+or the chain moves to a new block height. Identical requests that come
+in while a call is in flight wait for it instead of calling upstream
+again. Everything else is passed through unchanged.
+
+  python local_gateway.py -u https://api.testnet.chainweb.com -p 8090
+  KADENA_NODE_URL=http://localhost:8090 python portfolio.py -a k:...
+
+GET /metrics returns the hit rate and counters as json.
+"""
+import os
+import re
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+from kadena_sdk import blake_hash
+
+from fanout import create_session
+from clog import summarize
+
+TESTNET = {
+  'base_url': 'https://api.testnet.chainweb.com',
+}
+MAINNET = {
+  'base_url': 'https://api.chainweb.com',
+}
+NETWORK = TESTNET
+# KADENA_NODE_URL points the gateway at another upstream, e.g. local_chainweb.py
+UPSTREAM_URL = os.environ.get('KADENA_NODE_URL', NETWORK['base_url'])
+
+LOCAL_ROUTE = re.compile(r'^/chainweb/0\.0/([^/]+)/chain/(\d+)/pact/api/v1/local$')
+# The function a piece of code calls, e.g. free.nft-mint.get-collection-data
+_CALL = re.compile(r'^\s*\(\s*([\w.-]+)')
+
+# Seconds a getter's result is served from the cache, at most until the
+# next block. Functions that aren't listed are never cached.
+TTLS = {
+  'get-collection-data': 60,
+  'get-current-tier-for-collection': 10,
+  'get-pool-details': 30,
+  'get-sale-price': 30,
+  'available-supply': 5,
+}
+MAX_ENTRIES = 10000
+# Seconds between reads of the block heights
+HEIGHT_INTERVAL = 5
+
+
+def function_name(code):
+  """The unqualified name of the function the code calls, None if it isn't a call."""
+  match = _CALL.match(code)
+  return match.group(1).rsplit('.', 1)[-1] if match else None
+
+
+class Flight():
+  """An upstream call other requests for the same key can wait on."""
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.response = None
+    self.error = None
+
+
+class LocalCache():
+  """Cached /local responses and the calls in flight, safe across threads."""
+
+  def __init__(self, ttls=TTLS, max_entries=MAX_ENTRIES):
+    self.ttls = ttls
+    self.max_entries = max_entries
+    self.lock = threading.Lock()
+    self.entries = OrderedDict() # key -> { response, chain_id, height, filled_at }
+    self.inflight = {} # key -> Flight
+    self.heights = {} # chain_id -> latest block height seen
+    self.stats = {
+      'hits': 0,
+      'misses': 0,
+      'coalesced': 0,
+      'passthrough': 0,
+      'errors': 0,
+      'invalidations': 0,
+    }
+    self.functions = {} # function -> { hits, misses }
+
+
+  def _count(self, stat, function=None):
+    self.stats[stat] += 1
+    if function and stat in ['hits', 'misses', 'coalesced']:
+      counts = self.functions.setdefault(function, { 'hits': 0, 'misses': 0, 'coalesced': 0 })
+      counts[stat] += 1
+
+
+  def observe_height(self, chain_id, height):
+    """Drops the chain's entries once it moves to a new height."""
+    with self.lock:
+      if height <= self.heights.get(chain_id, -1):
+        return
+      self.heights[chain_id] = height
+      stale = [k for k, e in self.entries.items() if e['chain_id'] == chain_id and e['height'] != height]
+      for key in stale:
+        del self.entries[key]
+      self.stats['invalidations'] += len(stale)
+
+
+  def _fresh(self, entry, ttl):
+    return (time.time() - entry['filled_at'] < ttl
+      and entry['height'] == self.heights.get(entry['chain_id']))
+
+
+  def get(self, key, chain_id, function, fetch):
+    """Returns (status, body) for the key, calling fetch() at most once
+    for all the requests that want it at the same time."""
+    ttl = self.ttls[function]
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry and self._fresh(entry, ttl):
+        self.entries.move_to_end(key)
+        self._count('hits', function)
+        return entry['response']
+      flight = self.inflight.get(key)
+      leader = flight is None
+      if leader:
+        flight = self.inflight[key] = Flight()
+        height = self.heights.get(chain_id)
+      self._count('misses' if leader else 'coalesced', function)
+
+    if not leader:
+      flight.done.wait()
+      if flight.error:
+        raise flight.error
+      return flight.response
+
+    try:
+      flight.response = fetch()
+      self._store(key, chain_id, height, flight.response)
+      return flight.response
+    except Exception as e:
+      flight.error = e
+      with self.lock:
+        self.stats['errors'] += 1
+      raise
+    finally:
+      with self.lock:
+        del self.inflight[key]
+      flight.done.set()
+
+
+  def _store(self, key, chain_id, height, response):
+    """Only successful results are kept, and only if the chain didn't move
+    while they were fetched."""
+    status, body = response
+    try:
+      if status != 200 or json.loads(body)['result']['status'] != 'success':
+        return
+    except (ValueError, KeyError, TypeError):
+      return
+    with self.lock:
+      if height != self.heights.get(chain_id):
+        return
+      self.entries[key] = {
+        'response': response,
+        'chain_id': chain_id,
+        'height': height,
+        'filled_at': time.time(),
+      }
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+
+  def metrics(self):
+    with self.lock:
+      served = self.stats['hits'] + self.stats['coalesced']
+      requests = served + self.stats['misses']
+      return {
+        **self.stats,
+        'hit_rate': served / requests if requests else None,
+        'upstream_calls': self.stats['misses'] + self.stats['passthrough'],
+        'entries': len(self.entries),
+        'heights': dict(self.heights),
+        'functions': { f: dict(c) for f, c in self.functions.items() },
+      }
+
+
+class Gateway():
+  """Routes requests to the cache or straight to the upstream node."""
+
+  def __init__(self, upstream, cache=None, session=None, height_interval=HEIGHT_INTERVAL):
+    self.upstream = upstream.rstrip('/')
+    self.cache = cache or LocalCache()
+    self.session = session or create_session()
+    self.height_interval = height_interval
+
+
+  def forward(self, method, path, body=None):
+    resp = self.session.request(method, f'{self.upstream}{path}', data=body,
+      headers={ 'Content-Type': 'application/json' } if body is not None else None)
+    return resp.status_code, resp.content
+
+
+  def local(self, path, raw):
+    """Answers a /local call, from the cache when its function has a TTL."""
+    chain_id = LOCAL_ROUTE.match(path.split('?')[0]).group(2)
+    try:
+      signed = json.loads(raw)
+      exec_payload = json.loads(signed['cmd'])['payload']['exec']
+    except (ValueError, KeyError, TypeError):
+      exec_payload = None
+    function = function_name(exec_payload.get('code', '')) if exec_payload else None
+    if function not in self.cache.ttls:
+      with self.cache.lock:
+        self.cache.stats['passthrough'] += 1
+      return self.forward('POST', path, raw)
+
+    # The nonce and creation time differ between callers, so key on
+    # what the result depends on instead of the request hash
+    key = (chain_id, exec_payload['code'],
+      json.dumps(exec_payload.get('data') or {}, sort_keys=True), path.partition('?')[2])
+
+    def fetch():
+      status, body = self.forward('POST', path, raw)
+      if status == 200:
+        height = (json.loads(body).get('metaData') or {}).get('blockHeight')
+        if height is not None:
+          self.cache.observe_height(chain_id, height)
+      return status, body
+
+    status, body = self.cache.get(key, chain_id, function, fetch)
+    if status != 200:
+      return status, body
+    # Cached bodies carry the key of the request that filled them
+    result = json.loads(body)
+    result['reqKey'] = signed['hash']
+    return status, json.dumps(result).encode()
+
+
+  def watch_heights(self, network_id):
+    """Reads the cut so entries are dropped as soon as a chain moves,
+    not only when a /local response shows the new height."""
+    warned = False
+    while True:
+      try:
+        status, body = self.forward('GET', f'/chainweb/0.0/{network_id}/cut')
+        if status == 200:
+          for chain_id, tip in json.loads(body)['hashes'].items():
+            self.cache.observe_height(chain_id, tip['height'])
+        elif not warned:
+          print(f'Upstream has no cut endpoint ({status}), heights come from /local responses')
+          warned = True
+      except Exception as e:
+        print(f'Reading the cut failed: {e}')
+      time.sleep(self.height_interval)
+
+
+def make_handler(gateway, quiet=True):
+
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, without this keep-alive
+    # clients wait out the delayed ack on every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+      if not quiet:
+        super().log_message(*args)
+
+
+    def respond(self, code, body):
+      data = body if isinstance(body, bytes) else json.dumps(body).encode()
+      self.send_response(code)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+
+    def do_GET(self):
+      if self.path.rstrip('/') == '/metrics':
+        return self.respond(200, gateway.cache.metrics())
+      try:
+        self.respond(*gateway.forward('GET', self.path))
+      except Exception as e:
+        self.respond(502, { 'error': str(e) })
+
+
+    def do_POST(self):
+      raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+      try:
+        if LOCAL_ROUTE.match(self.path.split('?')[0]):
+          self.respond(*gateway.local(self.path, raw))
+        else:
+          self.respond(*gateway.forward('POST', self.path, raw))
+      except Exception as e:
+        self.respond(502, { 'error': str(e) })
+
+  return Handler
+
+
+def serve(gateway, host='127.0.0.1', port=8090, quiet=True):
+  server = ThreadingHTTPServer((host, port), make_handler(gateway, quiet))
+  server.daemon_threads = True
+  return server
+
+
+# -------------------------------
+# Benchmark
+
+GETTERS = [
+  '(free.nft-mint.get-collection-data "{collection}")',
+  '(free.nft-mint.get-current-tier-for-collection "{collection}")',
+  '(free.marmalade-nft-staking.get-pool-details "{pool}")',
+  '(free.token-sale-manager.get-sale-price "{sale}")',
+  '(free.token-sale-manager.available-supply "{sale}")',
+]
+
+
+def local_body(network_id, chain_id, code, nonce):
+  """An unsigned /local request, with its own nonce like a real client's."""
+  cmd = json.dumps({
+    'networkId': network_id,
+    'payload': { 'exec': { 'data': {}, 'code': code } },
+    'signers': [],
+    'meta': {
+      'gasLimit': 150000,
+      'chainId': chain_id,
+      'gasPrice': 1.0e-8,
+      'sender': '',
+      'ttl': 600,
+      'creationTime': round(time.time()) - 15,
+    },
+    'nonce': f'{time.time()}-{nonce}',
+  })
+  return json.dumps({ 'hash': blake_hash(cmd), 'sigs': [], 'cmd': cmd })
+
+
+def run_load(base_url, network_id, chain_id, codes, n, workers):
+  """Sends the codes round robin from the workers. Returns latencies and seconds.
+  Bodies are built up front so the clients only time the round trips."""
+  session = create_session(workers)
+  url = f'{base_url}/chainweb/0.0/{network_id}/chain/{chain_id}/pact/api/v1/local'
+  bodies = [local_body(network_id, chain_id, codes[i % len(codes)], i) for i in range(n)]
+
+  def call(body):
+    start = time.perf_counter()
+    resp = session.post(url, data=body, headers={ 'Content-Type': 'application/json' })
+    resp.raise_for_status()
+    return time.perf_counter() - start
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    latencies = list(executor.map(call, bodies))
+  return latencies, time.perf_counter() - start
+
+
+def free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+
+def benchmark(upstream, chain_id, n, workers, args):
+  """Runs the same getter mix against the upstream and through a gateway.
+  The gateway runs in its own process, like it would in production,
+  so it doesn't share the GIL with the clients."""
+  session = create_session(workers)
+  network_id = session.get(f'{upstream}/config').json()['chainwebVersion']
+  codes = [g.format(collection=args.collection, pool=args.pool, sale=args.sale) for g in GETTERS]
+
+  port = free_port()
+  gateway_url = f'http://127.0.0.1:{port}'
+  process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+    '-u', upstream, '-p', str(port), '-n', network_id, '--ttl', *(args.ttl or [])],
+    stdout=subprocess.DEVNULL)
+  try:
+    for _ in range(100):
+      try:
+        session.get(f'{gateway_url}/metrics')
+        break
+      except requests.ConnectionError:
+        time.sleep(0.1)
+
+    report = {}
+    for name, base_url in [('uncached', upstream), ('gateway', gateway_url)]:
+      latencies, elapsed = run_load(base_url, network_id, chain_id, codes, n, workers)
+      report[name] = {
+        'requests_per_sec': n / elapsed,
+        'latency': summarize(latencies),
+      }
+    report['uncached']['upstream_calls'] = n
+    report['metrics'] = session.get(f'{gateway_url}/metrics').json()
+    report['gateway']['upstream_calls'] = report['metrics']['upstream_calls']
+    report['speedup'] = report['gateway']['requests_per_sec'] / report['uncached']['requests_per_sec']
+    return report
+  finally:
+    process.terminate()
+
+
+def parse_ttls(values):
+  ttls = dict(TTLS)
+  for value in values or []:
+    function, _, seconds = value.partition('=')
+    ttls[function] = float(seconds)
+  return { f: t for f, t in ttls.items() if t > 0 }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-u', default=UPSTREAM_URL, help='Upstream node')
+  parser.add_argument('-p', type=int, default=8090, help='Port')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('-n', help='Network id for the height watcher, read from /config by default')
+  parser.add_argument('--ttl', nargs='*', metavar='FUNCTION=SECONDS',
+    help='Override or add a TTL, 0 turns caching off for the function')
+  parser.add_argument('--max-entries', type=int, default=MAX_ENTRIES)
+  parser.add_argument('--height-interval', type=float, default=HEIGHT_INTERVAL,
+    help='Seconds between reads of the block heights')
+  parser.add_argument('--benchmark', action='store_true',
+    help='Compare the upstream with and without the gateway instead of serving')
+  parser.add_argument('-c', default='1', help='Chain id used by the benchmark')
+  parser.add_argument('-r', type=int, default=2000, help='Requests per benchmark run')
+  parser.add_argument('-w', type=int, default=8, help='Concurrent benchmark clients')
+  parser.add_argument('--collection', default='test-collection')
+  parser.add_argument('--pool', default='pool1')
+  parser.add_argument('--sale', default='sale1')
+  parser.add_argument('-v', action='store_true', help='Log every request')
+  args = parser.parse_args()
+
+  if args.benchmark:
+    print(json.dumps(benchmark(args.u, args.c, args.r, args.w, args), indent=2))
+  else:
+    gateway = Gateway(args.u, LocalCache(parse_ttls(args.ttl), args.max_entries),
+      height_interval=args.height_interval)
+    network_id = args.n or gateway.session.get(f'{gateway.upstream}/config').json()['chainwebVersion']
+    threading.Thread(target=gateway.watch_heights, args=(network_id,), daemon=True).start()
+    server = serve(gateway, args.host, args.p, quiet=not args.v)
+    print(f'Caching /local for {gateway.upstream} on http://{args.host}:{args.p}')
+    server.serve_forever()
@@ -0,0 +1,86 @@
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from kadena_sdk.kadena_sdk import KadenaSdk
+
+from fanout import fan_out, create_session
+
+STAKING_CONTRACT = 'free.marmalade-nft-staking'
+BONDING_CONTRACT = 'free.marmalade-nft-bonding'
+
+MAINNET = {
+  'base_url': 'https://api.chainweb.com',
+  'chain_ids': [str(i) for i in range(20)],
+}
+TESTNET = {
+  'base_url': 'https://api.testnet.chainweb.com',
+  'chain_ids': [str(i) for i in range(20)],
+}
+NETWORK = TESTNET
+# KADENA_NODE_URL points the script at another node, e.g. local_chainweb.py
+BASE_URL = os.environ.get('KADENA_NODE_URL', NETWORK['base_url'])
+
+
+def read_portfolios(sdk, account, chain_ids, module, session):
+  """Reads one contract's portfolio on every chain.
+  Returns ({ chain_id: positions }, { chain_id: error })."""
+  payload = {
+    "exec": {
+      "data": { "account": account },
+      "code": f'({module}.get-account-portfolio (read-msg "account"))',
+    }
+  }
+
+  results = {}
+  errors = {}
+  for response in fan_out(sdk, payload, chain_ids, session=session, gas_limit=150000):
+    chain_id = response['chain_id']
+    if 'error' in response:
+      errors[chain_id] = response['error']
+    elif response['response']['result']['status'] != 'success':
+      errors[chain_id] = response['response']['result']['error']
+    else:
+      results[chain_id] = response['response']['result']['data']
+  return results, errors
+
+
+def get_portfolio(sdk, account, chain_ids, contracts):
+  """Queries every contract on every chain at once and merges the positions.
+  Each contract is read on its own, so one that is missing or fails on
+  a chain doesn't hide the other's positions there.
+  Returns the positions, tagged with their chain and contract,
+  and the errors, { chain_id: { contract: error } }."""
+  session = create_session(len(chain_ids) * len(contracts))
+  with ThreadPoolExecutor(max_workers=len(contracts)) as executor:
+    reads = {
+      name: executor.submit(read_portfolios, sdk, account, chain_ids, module, session)
+      for name, module in contracts.items()
+    }
+    reads = { name: future.result() for name, future in reads.items() }
+
+  positions = []
+  errors = {}
+  for chain_id in chain_ids:
+    for name, (results, contract_errors) in reads.items():
+      if chain_id in contract_errors:
+        errors.setdefault(chain_id, {})[name] = contract_errors[chain_id]
+      for position in results.get(chain_id, []):
+        positions.append({ 'chain-id': chain_id, 'contract': name, **position })
+
+  return positions, errors
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-a') # Account
+  parser.add_argument('-c', nargs='*', default=NETWORK['chain_ids']) # Chain ids
+  args = parser.parse_args()
+
+  sdk = KadenaSdk(BASE_URL)
+  positions, errors = get_portfolio(sdk, args.a, args.c, {
+    'staking': STAKING_CONTRACT,
+    'bonding': BONDING_CONTRACT,
+  })
+  print(json.dumps({ 'positions': positions, 'errors': errors }, indent=2))
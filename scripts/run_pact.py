@@ -1,4 +1,6 @@
 
+import os
+
 from kadena_sdk.kadena_sdk import KadenaSdk
 from kadena_sdk.key_pair import KeyPair
 
@@ -16,9 +18,11 @@ TESTNET = {
   'chain_id': '1',
 }
 NETWORK = TESTNET
+# KADENA_NODE_URL points the script at another node, e.g. local_chainweb.py
+BASE_URL = os.environ.get('KADENA_NODE_URL', NETWORK['base_url'])
 
 key_pair = KeyPair('keys.json')
-sdk = KadenaSdk(key_pair=key_pair)
+sdk = KadenaSdk(BASE_URL, key_pair=key_pair)
 
 payload = {
   "exec": {
@@ -0,0 +1,183 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+CACHE_FILE = '.repl-cache.json'
+# Seconds before a suite is killed
+TIMEOUT = 600
+SKIP_DIRS = ['.git', 'node_modules', '.venv', 'venv']
+
+_LOAD = re.compile(r'\(load\s+"([^"]+)"')
+_COMMENT = re.compile(r';[^\n]*')
+# Lines pact prints for failed expects and errors
+_FAILURE = re.compile(r'FAILURE:|Load failed')
+
+
+def loads(path):
+  """Paths of the files path loads. Pact resolves them from the
+  directory of the file doing the load."""
+  with open(path, 'r') as f:
+    code = _COMMENT.sub('', f.read())
+  directory = os.path.dirname(path)
+  return [os.path.normpath(os.path.join(directory, p)) for p in _LOAD.findall(code)]
+
+
+def load_closure(path):
+  """The suite and every file it loads, directly or not."""
+  seen = set()
+  stack = [os.path.normpath(path)]
+  while stack:
+    current = stack.pop()
+    if current in seen:
+      continue
+    seen.add(current)
+    if current.endswith('.repl') and os.path.exists(current):
+      stack.extend(loads(current))
+  return seen
+
+
+def find_suites(root, skip_dirs=SKIP_DIRS):
+  """Every .repl file no other .repl file loads. The rest (kda-env,
+  dependencies, shared env files) only set up the suites."""
+  repls = []
+  for directory, dirs, files in os.walk(root):
+    dirs[:] = sorted(d for d in dirs if d not in skip_dirs)
+    repls.extend(os.path.join(directory, f) for f in sorted(files) if f.endswith('.repl'))
+
+  loaded = set()
+  for path in repls:
+    loaded.update(loads(path))
+  return [p for p in repls if os.path.normpath(p) not in loaded]
+
+
+def file_hash(path):
+  if not os.path.exists(path):
+    return 'missing'
+  with open(path, 'rb') as f:
+    return hashlib.sha256(f.read()).hexdigest()
+
+
+def suite_key(path, root, pact_version):
+  """Hash of the suite, every file it loads and the pact version.
+  Changes if any of them do."""
+  h = hashlib.sha256(pact_version.encode('utf8'))
+  for file in sorted(load_closure(path)):
+    h.update(f'{os.path.relpath(file, root)}:{file_hash(file)}\n'.encode('utf8'))
+  return h.hexdigest()
+
+
+def pact_version(pact):
+  try:
+    return subprocess.run([pact, '--version'], capture_output=True, text=True, timeout=30).stdout.strip()
+  except (OSError, subprocess.TimeoutExpired):
+    return ''
+
+
+# -------------------------------
+# Cache
+
+def read_cache(path):
+  if not os.path.exists(path):
+    return {}
+  with open(path, 'r') as f:
+    return json.load(f)
+
+
+def write_cache(path, cache):
+  tmp = f'{path}.tmp'
+  with open(tmp, 'w') as f:
+    json.dump(cache, f, indent=2, sort_keys=True)
+  os.replace(tmp, path)
+
+
+# -------------------------------
+# Running
+
+def run_suite(pact, path, timeout=TIMEOUT):
+  """Runs a suite from its own directory. Returns (passed, output, seconds)."""
+  start = time.perf_counter()
+  try:
+    proc = subprocess.run([pact, os.path.basename(path)],
+      cwd=os.path.dirname(path), capture_output=True, text=True, timeout=timeout)
+    output = proc.stdout + proc.stderr
+    passed = proc.returncode == 0 and not _FAILURE.search(output)
+  except subprocess.TimeoutExpired:
+    output = f'Timed out after {timeout}s'
+    passed = False
+  return passed, output, time.perf_counter() - start
+
+
+def run_all(suites, pact, root=ROOT, cache_path=None, workers=None, use_cache=True, verbose=False):
+  """Runs the suites whose key isn't in the cache, a suite per core.
+  Only passes are cached, so failing suites always run again.
+  Returns { suite: 'cached', 'passed' or 'failed' }."""
+  cache_path = cache_path or os.path.join(root, CACHE_FILE)
+  cache = read_cache(cache_path) if use_cache else {}
+  version = pact_version(pact)
+
+  results = {}
+  to_run = {}
+  for suite in suites:
+    name = os.path.relpath(suite, root)
+    key = suite_key(suite, root, version)
+    if cache.get(name) == key:
+      results[name] = 'cached'
+      print(f'{name}: cached')
+    else:
+      to_run[name] = (suite, key)
+
+  with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+    futures = {
+      executor.submit(run_suite, pact, suite): (name, key)
+      for name, (suite, key) in to_run.items()
+    }
+    for future in as_completed(futures):
+      name, key = futures[future]
+      passed, output, elapsed = future.result()
+      results[name] = 'passed' if passed else 'failed'
+      print(f'{name}: {results[name]} ({elapsed:.1f}s)')
+      if passed:
+        cache[name] = key
+      else:
+        cache.pop(name, None)
+      if verbose or not passed:
+        print(output)
+      # Written as suites finish so an interrupted run keeps its passes
+      write_cache(cache_path, cache)
+  return results
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('suites', nargs='*', help='Suites to run, every suite in the repo by default')
+  parser.add_argument('-j', type=int, default=os.cpu_count(), help='Suites run at once')
+  parser.add_argument('--pact', default=shutil.which('pact'), help='Path to the pact binary')
+  parser.add_argument('--no-cache', action='store_true', help='Run every suite')
+  parser.add_argument('--list', action='store_true', help='Only list the suites and what they load')
+  parser.add_argument('-v', action='store_true', help='Print the output of passing suites too')
+  args = parser.parse_args()
+
+  suites = [os.path.abspath(s) for s in args.suites] or find_suites(ROOT)
+  if args.list:
+    for suite in suites:
+      print(os.path.relpath(suite, ROOT))
+      for file in sorted(load_closure(suite) - {suite}):
+        print(f'  {os.path.relpath(file, ROOT)}{"" if os.path.exists(file) else " (missing)"}')
+    sys.exit(0)
+  if not args.pact:
+    sys.exit('No pact binary found, install pact or pass --pact')
+
+  start = time.perf_counter()
+  results = run_all(suites, args.pact, workers=args.j, use_cache=not args.no_cache, verbose=args.v)
+  counts = { status: list(results.values()).count(status) for status in ['passed', 'cached', 'failed'] }
+  print(f'{counts} in {time.perf_counter() - start:.1f}s')
+  if counts['failed']:
+    sys.exit(1)
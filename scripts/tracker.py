@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import argparse
+
+from kadena_sdk.kadena_sdk import KadenaSdk
+
+from fanout import create_session
+
+TESTNET = {
+  'base_url': 'https://api.testnet.chainweb.com',
+}
+MAINNET = {
+  'base_url': 'https://api.chainweb.com',
+}
+NETWORK = TESTNET
+# KADENA_NODE_URL points the script at another node, e.g. local_chainweb.py
+BASE_URL = os.environ.get('KADENA_NODE_URL', NETWORK['base_url'])
+
+POLL = '/poll'
+# Request keys sent in a single /poll
+POLL_BATCH_SIZE = 100
+MIN_INTERVAL = 1
+MAX_INTERVAL = 30
+BACKOFF = 1.5
+# Seconds before giving up on a key that never shows up
+TIMEOUT = 900
+
+
+class ResultStore():
+  """Final status of every tracked request key, in a local sqlite file."""
+
+  def __init__(self, path='requests.db'):
+    self.db = sqlite3.connect(path)
+    self.db.execute('''
+      CREATE TABLE IF NOT EXISTS requests (
+        request_key TEXT PRIMARY KEY,
+        chain_id TEXT,
+        status TEXT,
+        result TEXT,
+        confirmed_at REAL
+      )''')
+    self.db.commit()
+
+
+  def get(self, request_key):
+    row = self.db.execute(
+      'SELECT chain_id, status, result FROM requests WHERE request_key = ?',
+      (request_key,)).fetchone()
+    if row is None:
+      return None
+    return {
+      'requestKey': request_key,
+      'chainId': row[0],
+      'status': row[1],
+      'result': json.loads(row[2]),
+    }
+
+
+  def save(self, results):
+    self.db.executemany(
+      'INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?, ?)',
+      [(r['requestKey'], r['chainId'], r['status'], json.dumps(r['result']), time.time())
+        for r in results])
+    self.db.commit()
+
+
+class RequestTracker():
+  """Confirms many request keys with batched /poll calls instead of a
+  /listen per transaction.
+
+  Keys are grouped by chain and polled POLL_BATCH_SIZE at a time. The
+  poll interval grows while nothing new is mined and drops back once
+  results come in. Final statuses are saved to the ResultStore, and keys
+  already in it are resolved without polling.
+
+    tracker = RequestTracker(sdk)
+    future = tracker.track(request_key, '1', callback=print)
+    await tracker.run()
+    result = await future
+  """
+
+  def __init__(self, sdk, store=None, session=None, batch_size=POLL_BATCH_SIZE,
+    min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, timeout=TIMEOUT):
+    self.sdk = sdk
+    self.store = store or ResultStore()
+    self.session = session or create_session()
+    self.batch_size = batch_size
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.timeout = timeout
+    self.pending = {} # chain_id -> { request_key: (future, callback, added_at) }
+    self.polls = 0
+
+
+  def track(self, request_key, chain_id, callback=None):
+    """Starts tracking a request key. Returns a future that resolves to
+    { requestKey, chainId, status, result }, and calls callback with the
+    same dict. Must be called from the running event loop."""
+    future = asyncio.get_running_loop().create_future()
+    stored = self.store.get(request_key)
+    if stored:
+      self._resolve(stored, future, callback)
+    else:
+      self.pending.setdefault(chain_id, {})[request_key] = (future, callback, time.time())
+    return future
+
+
+  def _resolve(self, result, future, callback):
+    if not future.done():
+      future.set_result(result)
+    if callback:
+      callback(result)
+
+
+  def _poll(self, chain_id, request_keys):
+    resp = self.session.post(self.sdk.build_url(POLL, chain_id),
+      json={'requestKeys': request_keys})
+    resp.raise_for_status()
+    return resp.json()
+
+
+  def _batches(self):
+    for chain_id, keys in self.pending.items():
+      keys = list(keys)
+      for i in range(0, len(keys), self.batch_size):
+        yield chain_id, keys[i:i + self.batch_size]
+
+
+  async def run(self):
+    """Polls until every tracked key is confirmed or timed out.
+    Keys tracked while it runs are picked up on the next round."""
+    interval = self.min_interval
+    while any(self.pending.values()):
+      batches = list(self._batches())
+      self.polls += len(batches)
+      responses = await asyncio.gather(
+        *(asyncio.to_thread(self._poll, chain_id, keys) for chain_id, keys in batches),
+        return_exceptions=True)
+
+      confirmed = []
+      for (chain_id, _), response in zip(batches, responses):
+        if isinstance(response, Exception):
+          print(f'Poll on chain {chain_id} failed: {response}')
+          continue
+        for request_key, result in response.items():
+          entry = self.pending[chain_id].pop(request_key, None)
+          if entry is None:
+            continue
+          result = {
+            'requestKey': request_key,
+            'chainId': chain_id,
+            'status': result['result']['status'],
+            'result': result,
+          }
+          confirmed.append(result)
+          self._resolve(result, entry[0], entry[1])
+      if confirmed:
+        self.store.save(confirmed)
+
+      now = time.time()
+      for chain_id, keys in self.pending.items():
+        for request_key, (future, callback, added_at) in list(keys.items()):
+          if now - added_at > self.timeout:
+            # Not saved, a later run can still find it
+            keys.pop(request_key)
+            self._resolve({
+              'requestKey': request_key,
+              'chainId': chain_id,
+              'status': 'timeout',
+              'result': None,
+            }, future, callback)
+
+      interval = self.min_interval if confirmed else min(interval * BACKOFF, self.max_interval)
+      if any(self.pending.values()):
+        await asyncio.sleep(interval)
+
+
+async def confirm_all(sdk, request_keys, callback=None, **kwargs):
+  """Confirms { chain_id: [request_key] } and returns the results by key."""
+  tracker = RequestTracker(sdk, **kwargs)
+  futures = [
+    tracker.track(key, chain_id, callback)
+    for chain_id, keys in request_keys.items()
+    for key in keys
+  ]
+  await tracker.run()
+  results = await asyncio.gather(*futures)
+  return { r['requestKey']: r for r in results }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-k', nargs='+', help='Request keys')
+  parser.add_argument('-c', default='1', help='Chain id of the request keys')
+  parser.add_argument('-s', default='requests.db', help='Result store')
+  args = parser.parse_args()
+
+  sdk = KadenaSdk(BASE_URL)
+  results = asyncio.run(confirm_all(sdk, { args.c: args.k },
+    callback=lambda r: print(f'{r["requestKey"]}: {r["status"]}'),
+    store=ResultStore(args.s)))
+  print(json.dumps(results, indent=2))